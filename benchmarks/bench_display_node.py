@@ -0,0 +1,81 @@
+# Copyright (C) 2014 Diane Trout
+#
+# This package is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License Version 2.1
+# as published by the Free Software Foundation or any newer version.
+
+# This package is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License Version 2.1 for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License Version 2.1 along with this package; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor, Boston,
+# MA 02110-1301 USA
+"""Measure how many nodes per second display_node can shorten to curies
+
+    python -m benchmarks.bench_display_node --prefixes 60 --nodes 300000
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+import RDF
+import rdfmagic
+
+
+def linear_display_node(node, namespaces):
+    """The original scan over every namespace, kept for comparison"""
+    uri = str(node.uri)
+    match = ""
+    for namespace in namespaces:
+        if uri.startswith(namespace) and len(namespace) > len(match):
+            match = namespace
+    if match:
+        return "{0}:{1}".format(namespaces[match], uri[len(match):])
+    return uri
+
+
+def make_nodes(prefixes, count, distinct):
+    namespaces = dict(
+        ('http://example.org/vocab{0}/'.format(i), 'v{0}'.format(i))
+        for i in range(prefixes))
+    names = sorted(namespaces)
+    nodes = [RDF.Node(RDF.Uri('{0}term{1}'.format(names[i % prefixes], i)))
+             for i in range(distinct)]
+    return namespaces, [nodes[i % distinct] for i in range(count)]
+
+
+def timed(label, count, func, nodes):
+    start = time.time()
+    for node in nodes:
+        func(node)
+    elapsed = time.time() - start
+    print('{0}\t{1:.3f}\t{2:.0f}'.format(label, elapsed, count / elapsed))
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prefixes', type=int, default=60)
+    parser.add_argument('--nodes', type=int, default=300000)
+    parser.add_argument('--distinct', type=int, default=20000,
+                        help='number of different uris among the nodes')
+    args = parser.parse_args(cmdline)
+
+    namespaces, nodes = make_nodes(args.prefixes, args.nodes, args.distinct)
+    for namespace, prefix in namespaces.items():
+        rdfmagic._namespaces[namespace] = prefix
+        rdfmagic._prefixes[prefix] = namespace
+        rdfmagic._namespace_index.add(namespace, prefix)
+
+    print('method\tseconds\tnodes_per_second')
+    timed('linear', args.nodes,
+          lambda n: linear_display_node(n, rdfmagic._namespaces), nodes)
+    timed('index', args.nodes,
+          lambda n: rdfmagic.display_node(n, 'text/plain'), nodes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# Copyright (C) 2014 Diane Trout
+#
+# This package is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License Version 2.1
+# as published by the Free Software Foundation or any newer version.
+
+# This package is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License Version 2.1 for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License Version 2.1 along with this package; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor, Boston,
+# MA 02110-1301 USA
+"""Compare peak memory and wall time of reading a source into a string
+before parsing against letting librdf stream it from disk.
+
+    python -m benchmarks.bench_load_source --triples 1000000
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import generate_file
+
+
+def load_string(pathname):
+    """The original path, read the whole body and then parse it"""
+    import RDF
+    import rdfmagic
+    model = rdfmagic.make_temp_model()
+    parser = RDF.Parser(name='ntriples')
+    with open(pathname, 'rt') as instream:
+        body = instream.read()
+    parser.parse_string_into_model(model, body, 'file://' + pathname)
+    return model
+
+
+def load_stream(pathname):
+    import rdfmagic
+    rdfmagic.set_option('cache.enabled', False)
+    model = rdfmagic.make_temp_model()
+    rdfmagic.load_source(model, pathname)
+    return model
+
+
+METHODS = {
+    'string': load_string,
+    'stream': load_stream,
+}
+
+
+def run_one(method, pathname):
+    start = time.time()
+    model = METHODS[method](pathname)
+    elapsed = time.time() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('{0}\t{1}\t{2:.3f}\t{3}'.format(method, len(model), elapsed, maxrss))
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--triples', type=int, default=1000000)
+    parser.add_argument('--method', choices=sorted(METHODS), default=None,
+                        help='run a single method in this process')
+    parser.add_argument('--source', default=None,
+                        help='use an existing file instead of generating one')
+    args = parser.parse_args(cmdline)
+
+    if args.method is not None:
+        run_one(args.method, args.source)
+        return
+
+    tempdir = tempfile.mkdtemp(prefix='bench_rdfm_')
+    pathname = args.source
+    if pathname is None:
+        pathname = os.path.join(tempdir, 'generated.nt')
+        generate_file(pathname, args.triples, 'ntriples')
+
+    print('method\ttriples\tseconds\tmaxrss_kb')
+    try:
+        for method in sorted(METHODS):
+            # each method gets a fresh process so peak RSS is comparable
+            subprocess.check_call([
+                sys.executable, '-m', 'benchmarks.bench_load_source',
+                '--method', method, '--source', pathname])
+    finally:
+        if args.source is None:
+            os.unlink(pathname)
+        os.rmdir(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Copyright (C) 2014 Diane Trout
+#
+# This package is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License Version 2.1
+# as published by the Free Software Foundation or any newer version.
+
+# This package is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License Version 2.1 for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License Version 2.1 along with this package; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor, Boston,
+# MA 02110-1301 USA
+"""Write synthetic RDF for benchmarks
+
+Subjects and predicates are spread over a configurable number of
+namespaces, and every tenth triple is a literal of the requested size.
+The same arguments always produce the same file.
+
+    python -m benchmarks.generate --triples 100000 --format turtle out.ttl
+"""
+from __future__ import print_function
+
+import argparse
+import random
+
+
+def namespaces(count):
+    return ['http://example.org/vocab{0}/'.format(i) for i in range(count)]
+
+
+def generate_triples(triples, namespace_count=10, literal_size=32, seed=0):
+    """Yield (subject, predicate, object, is_literal) tuples
+    """
+    rng = random.Random(seed)
+    spaces = namespaces(namespace_count)
+    subjects = max(1, triples // 10)
+    filler = 'x' * literal_size
+    for i in range(triples):
+        subject = '{0}s{1}'.format(spaces[(i // 10) % namespace_count], i // 10)
+        predicate = '{0}p{1}'.format(spaces[i % namespace_count], i % 10)
+        if i % 10 == 0:
+            yield subject, predicate, '{0} {1}'.format(i, filler)[:literal_size], True
+        else:
+            target = rng.randrange(subjects)
+            obj = '{0}s{1}'.format(spaces[target % namespace_count], target)
+            yield subject, predicate, obj, False
+
+
+def write_ntriples(outstream, triples, **kwargs):
+    for s, p, o, is_literal in generate_triples(triples, **kwargs):
+        if is_literal:
+            o = '"{0}"'.format(o)
+        else:
+            o = '<{0}>'.format(o)
+        outstream.write('<{0}> <{1}> {2} .\n'.format(s, p, o))
+
+
+def write_turtle(outstream, triples, namespace_count=10, **kwargs):
+    """Write turtle using prefixes and grouping predicates by subject
+    """
+    spaces = namespaces(namespace_count)
+    for i, namespace in enumerate(spaces):
+        outstream.write('@prefix v{0}: <{1}> .\n'.format(i, namespace))
+
+    def curie(uri):
+        for i, namespace in enumerate(spaces):
+            if uri.startswith(namespace):
+                return 'v{0}:{1}'.format(i, uri[len(namespace):])
+        return '<{0}>'.format(uri)
+
+    current = None
+    for s, p, o, is_literal in generate_triples(
+            triples, namespace_count=namespace_count, **kwargs):
+        o = '"{0}"'.format(o) if is_literal else curie(o)
+        if s != current:
+            if current is not None:
+                outstream.write(' .\n')
+            outstream.write('{0} {1} {2}'.format(curie(s), curie(p), o))
+            current = s
+        else:
+            outstream.write(' ;\n    {0} {1}'.format(curie(p), o))
+    if current is not None:
+        outstream.write(' .\n')
+
+
+WRITERS = {
+    'ntriples': write_ntriples,
+    'turtle': write_turtle,
+}
+
+
+def generate_file(pathname, triples, format='ntriples', namespace_count=10,
+                  literal_size=32, seed=0):
+    with open(pathname, 'wt') as outstream:
+        WRITERS[format](outstream, triples, namespace_count=namespace_count,
+                        literal_size=literal_size, seed=seed)
+    return pathname
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename')
+    parser.add_argument('--triples', type=int, default=10000)
+    parser.add_argument('--format', choices=sorted(WRITERS), default='ntriples')
+    parser.add_argument('--namespaces', type=int, default=10)
+    parser.add_argument('--literal-size', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(cmdline)
+    generate_file(args.filename, args.triples, args.format, args.namespaces,
+                  args.literal_size, args.seed)
+
+
+if __name__ == '__main__':
+    main()
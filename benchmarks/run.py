@@ -0,0 +1,226 @@
+# Copyright (C) 2014 Diane Trout
+#
+# This package is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License Version 2.1
+# as published by the Free Software Foundation or any newer version.
+
+# This package is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License Version 2.1 for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License Version 2.1 along with this package; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor, Boston,
+# MA 02110-1301 USA
+"""Benchmark the load, query and render pipeline on synthetic data
+
+Every case runs in its own process so its peak memory can be measured.
+Results can be saved as a baseline and later runs compared against it.
+
+    python -m benchmarks.run --triples 100000 --save baseline.json
+    python -m benchmarks.run --triples 100000 --compare baseline.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import generate_file, namespaces
+
+SELECT_ALL = "select ?s ?p ?o where { ?s ?p ?o . }"
+
+
+def load(pathname):
+    import rdfmagic
+    model = rdfmagic.make_temp_model()
+    rdfmagic.load_source(model, pathname)
+    return model
+
+
+def case_parse_turtle(files, args):
+    start = time.time()
+    model = load(files['turtle'])
+    return time.time() - start, len(model)
+
+
+def case_parse_ntriples(files, args):
+    start = time.time()
+    model = load(files['ntriples'])
+    return time.time() - start, len(model)
+
+
+def case_query(files, args):
+    """Time to execute the query, without reading any rows"""
+    import RDF
+    import rdfmagic
+    model = load(files['ntriples'])
+    start = time.time()
+    result_set = RDF.SPARQLQuery(rdfmagic.prepare_query(SELECT_ALL)).execute(model)
+    rdfmagic.LibRdfResults(result_set, lazy=True)
+    return time.time() - start, 1
+
+
+def case_materialize(files, args):
+    import RDF
+    import rdfmagic
+    model = load(files['ntriples'])
+    result_set = RDF.SPARQLQuery(rdfmagic.prepare_query(SELECT_ALL)).execute(model)
+    start = time.time()
+    results = rdfmagic.LibRdfResults(result_set)
+    return time.time() - start, len(results)
+
+
+def render_results(files, args, method):
+    import RDF
+    import rdfmagic
+    model = load(files['ntriples'])
+    result_set = RDF.SPARQLQuery(rdfmagic.prepare_query(SELECT_ALL)).execute(model)
+    results = rdfmagic.LibRdfResults(result_set)
+    rdfmagic.set_option('display.max_rows', args.render_rows)
+    start = time.time()
+    method(results)
+    return time.time() - start, min(len(results), args.render_rows)
+
+
+def case_render_text(files, args):
+    return render_results(files, args, str)
+
+
+def case_render_html(files, args):
+    return render_results(files, args, lambda r: r._repr_html_())
+
+
+def case_display_node(files, args):
+    import rdfmagic
+    for i, namespace in enumerate(namespaces(args.namespaces)):
+        rdfmagic._namespace_index.add(namespace, 'v{0}'.format(i))
+    model = load(files['ntriples'])
+    nodes = []
+    for statement in model:
+        nodes.extend((statement.subject, statement.predicate, statement.object))
+    start = time.time()
+    for node in nodes:
+        rdfmagic.display_node(node, 'text/html')
+    return time.time() - start, len(nodes)
+
+
+CASES = {
+    'display_node': case_display_node,
+    'parse_turtle': case_parse_turtle,
+    'parse_ntriples': case_parse_ntriples,
+    'query': case_query,
+    'materialize': case_materialize,
+    'render_text': case_render_text,
+    'render_html': case_render_html,
+}
+
+
+def run_case(name, files, args):
+    import rdfmagic
+    rdfmagic.set_option('cache.enabled', False)
+    seconds, items = CASES[name](files, args)
+    return {
+        'seconds': seconds,
+        'items': items,
+        'items_per_second': items / seconds if seconds else None,
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print changes against a baseline and return the regressed cases
+    """
+    regressions = []
+    print('case\tbaseline\tcurrent\tchange')
+    for name, current in sorted(results['cases'].items()):
+        previous = baseline['cases'].get(name)
+        if previous is None:
+            continue
+        change = (current['seconds'] - previous['seconds']) / previous['seconds'] \
+            if previous['seconds'] else 0.0
+        print('{0}\t{1:.3f}\t{2:.3f}\t{3:+.1%}'.format(
+            name, previous['seconds'], current['seconds'], change))
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--triples', type=int, default=10000,
+                        help='size of generated data, 10k to 10M is sensible')
+    parser.add_argument('--namespaces', type=int, default=10)
+    parser.add_argument('--literal-size', type=int, default=32)
+    parser.add_argument('--render-rows', type=int, default=10000,
+                        help='rows to render in the render cases')
+    parser.add_argument('--case', action='append', choices=sorted(CASES),
+                        help='run only these cases')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slow down before a case is a regression')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--files', help=argparse.SUPPRESS)
+    return parser
+
+
+def main(cmdline=None):
+    args = make_parser().parse_args(cmdline)
+    if args.child is not None:
+        result = run_case(args.child, json.loads(args.files), args)
+        print(json.dumps(result))
+        return 0
+
+    tempdir = tempfile.mkdtemp(prefix='bench_rdfm_')
+    try:
+        files = {}
+        for format, ext in (('ntriples', '.nt'), ('turtle', '.ttl')):
+            files[format] = generate_file(
+                os.path.join(tempdir, 'generated' + ext), args.triples,
+                format, args.namespaces, args.literal_size)
+
+        results = {
+            'triples': args.triples,
+            'namespaces': args.namespaces,
+            'literal_size': args.literal_size,
+            'python': platform.python_version(),
+            'cases': {},
+        }
+        for name in args.case or sorted(CASES):
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.run',
+                '--child', name, '--files', json.dumps(files),
+                '--render-rows', str(args.render_rows),
+                '--namespaces', str(args.namespaces)])
+            results['cases'][name] = json.loads(output.decode('utf-8').splitlines()[-1])
+            case = results['cases'][name]
+            print('{0}\t{1:.3f}s\t{2} items\tmaxrss {3}'.format(
+                name, case['seconds'], case['items'], case['maxrss']))
+    finally:
+        shutil.rmtree(tempdir)
+
+    if args.save:
+        with open(args.save, 'wt') as outstream:
+            json.dump(results, outstream, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'rt') as instream:
+            baseline = json.load(instream)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,17 +14,46 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor, Boston,
 # MA 02110-1301 USA
 
+from __future__ import print_function
+
+import array
+import atexit
+import base64
+import contextlib
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import math
 import os
 import re
+import shutil
 import six
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor
 
-from six.moves import range
+from six.moves import range, http_client, queue
 from six.moves.urllib.error import HTTPError
-from six.moves.urllib.parse import urlparse
-from six.moves.urllib.request import urlopen
+from six.moves.urllib.parse import urlparse, urlencode
+from six.moves.urllib.request import urlopen, Request
 
 import RDF
 import collections
+from xml.etree import ElementTree
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from IPython.core.magic import (Magics, magics_class, cell_magic, line_magic,
                                 line_cell_magic, UsageError)
@@ -44,10 +73,156 @@ _prefixes = {
 }
 _namespaces = dict(( (v, k) for k, v in _prefixes.items()))
 
+_options = {
+    'cache.enabled': False,
+    'cache.dir': os.path.join(os.path.expanduser('~'), '.cache', 'rdfmagic'),
+    'cache.max_size': 2 * 1024 ** 3,
+    'models.max_temp': 8,
+    'load.jobs': 1,
+    'load.chunk_size': 16 * 1024 ** 2,
+    'results.lazy': False,
+    'display.max_rows': 60,
+    'query_cache.max_entries': 32,
+    'background.workers': 2,
+    'save.large_model': 1000000,
+    'profile.enabled': False,
+    'bind.batch_size': 500,
+    'export.batch_size': 10000,
+    'into.batch_size': 100000,
+    'load.stats': False,
+}
+
+logger = logging.getLogger('rdfmagic')
+
+def get_option(name):
+    if name not in _options:
+        raise KeyError("Unknown option {0}".format(name))
+    return _options[name]
+
+def set_option(name, value):
+    """Set an option, converting value to the type of the current setting
+    """
+    current = get_option(name)
+    if isinstance(value, six.string_types) and not isinstance(current, six.string_types):
+        if isinstance(current, bool):
+            value = value.lower() in ('1', 'true', 'yes', 'on')
+        else:
+            value = type(current)(value)
+    _options[name] = value
+
+STORAGE_TYPES = ('hashes', 'sqlite')
+
+def open_model(storage, path, name, create=False):
+    """Open or create a model kept on disk
+
+    hashes storage uses Berkeley DB index files named after name inside
+    the path directory, sqlite storage uses path as the database file.
+    Both are opened with context support.
+
+    returns (model, sources_file) where sources_file is where the list of
+    loaded sources should be kept.
+    """
+    new = 'yes' if create else 'no'
+    if storage == 'hashes':
+        if not create and \
+           not os.path.exists(os.path.join(path, name + '-sp2o.db')):
+            raise IOError("No hashes store named {0} in {1}".format(name, path))
+        if create and not os.path.exists(path):
+            os.makedirs(path)
+        store = RDF.HashStorage(name, options=(
+            "new='{0}',hash-type='bdb',dir='{1}',contexts='yes'".format(
+                new, path)))
+        sources_file = os.path.join(path, name + '-sources.json')
+    elif storage == 'sqlite':
+        if not create and not os.path.exists(path):
+            raise IOError("No sqlite store at {0}".format(path))
+        store = RDF.Storage(storage_name='sqlite', name=path,
+                            options_string="new='{0}'".format(new))
+        sources_file = path + '-sources.json'
+    else:
+        raise ValueError("Unknown storage type {0}".format(storage))
+    if create:
+        for stale in (sources_file, stats_file_for(sources_file)):
+            if os.path.exists(stale):
+                os.unlink(stale)
+    return RDF.Model(store), sources_file
+
 def dump_model(model):
     export = RDF.Serializer(name='turtle')
     print (export.serialize_model_to_string(model))
 
+class NamespaceIndex(object):
+    """Find the longest registered namespace that starts a uri
+
+    Namespaces are stored in a character trie so a lookup costs at most
+    len(uri) steps no matter how many namespaces there are. Recently
+    shortened uris are remembered in a bounded LRU cache, which is
+    cleared whenever a namespace is added or removed.
+    """
+    def __init__(self, namespaces=None, cache_size=8192):
+        self._root = {}
+        self._cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        if namespaces is not None:
+            for namespace, prefix in namespaces.items():
+                self.add(namespace, prefix)
+
+    def add(self, namespace, prefix):
+        node = self._root
+        for c in namespace:
+            node = node.setdefault(c, {})
+        node[None] = prefix
+        self._cache.clear()
+
+    def remove(self, namespace):
+        path = [self._root]
+        for c in namespace:
+            node = path[-1].get(c)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].pop(None, None)
+        # prune branches that no longer lead to a namespace
+        for i in range(len(namespace), 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][namespace[i - 1]]
+        self._cache.clear()
+
+    def match(self, uri):
+        """Return (namespace length, prefix) of the longest match or None
+        """
+        node = self._root
+        best = None
+        for i, c in enumerate(uri):
+            if None in node:
+                best = (i, node[None])
+            node = node.get(c)
+            if node is None:
+                return best
+        if None in node:
+            best = (len(uri), node[None])
+        return best
+
+    def shorten(self, uri):
+        """Return the curie for uri, or uri if no namespace matches
+        """
+        cache = self._cache
+        curie = cache.pop(uri, None)
+        if curie is None:
+            found = self.match(uri)
+            if found is None:
+                curie = uri
+            else:
+                length, prefix = found
+                curie = "{0}:{1}".format(prefix, uri[length:])
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        cache[uri] = curie
+        return curie
+
+_namespace_index = NamespaceIndex(_namespaces)
+
 def display_node(node, mime_type):
     if mime_type == 'text/html':
         template = '<a href="{anchor}">{curie}</a>'
@@ -55,22 +230,39 @@ def display_node(node, mime_type):
         template = '{curie}'
 
     if isinstance(node, RDF.Node) and node.is_resource():
-        match = ""
         uri = str(node.uri)
-        curie = uri
-        for namespace, prefix in _namespaces.items():
-            if uri.startswith(namespace) and len(namespace) > len(match):
-                match = namespace
-
-        if len(match) > 0:
-            prefix = _namespaces[match]
-            curie = uri.replace(match, "{0}:".format(prefix))
-
+        curie = _namespace_index.shorten(uri)
         return template.format(anchor=uri, curie=curie)
     else:
         return str(node)
 
 
+XSD = "http://www.w3.org/2001/XMLSchema#"
+_xsd_kinds = {}
+for _name in ('integer', 'int', 'long', 'short', 'byte', 'nonNegativeInteger',
+              'nonPositiveInteger', 'negativeInteger', 'positiveInteger',
+              'unsignedLong', 'unsignedInt', 'unsignedShort', 'unsignedByte'):
+    _xsd_kinds[XSD + _name] = 'integer'
+for _name in ('decimal', 'double', 'float'):
+    _xsd_kinds[XSD + _name] = 'float'
+_xsd_kinds[XSD + 'boolean'] = 'boolean'
+_xsd_kinds[XSD + 'date'] = 'datetime'
+_xsd_kinds[XSD + 'dateTime'] = 'datetime'
+
+def node_kind(node):
+    """Classify a node as uri, integer, float, boolean, datetime or string
+    """
+    if node is None:
+        return None
+    if isinstance(node, RDF.Node):
+        if node.is_resource():
+            return 'uri'
+        if node.is_literal():
+            datatype = node.literal_value.get('datatype')
+            if datatype is not None:
+                return _xsd_kinds.get(str(datatype), 'string')
+    return 'string'
+
 class Node(RDF.Node):
     def _repr_html_(self):
         return display_node(self, mime_type='text/html')
@@ -78,13 +270,103 @@ class Node(RDF.Node):
 Uri = RDF.Uri
 NS = RDF.NS
 
+def node_key(node):
+    """Return a hashable key that is equal for equal nodes
+    """
+    if node is None:
+        return None
+    if isinstance(node, RDF.Node):
+        if node.is_resource():
+            return ('uri', str(node.uri))
+        elif node.is_blank():
+            return ('blank', node.blank_identifier)
+        literal = node.literal_value
+        datatype = literal.get('datatype')
+        return ('literal', literal.get('string'), literal.get('language'),
+                str(datatype) if datatype is not None else None)
+    return ('value', node)
+
+
+class ResultRow(collections.Mapping):
+    """Read only view of one row of a LibRdfResults
+    """
+    __slots__ = ('_results', '_index')
+
+    def __init__(self, results, index):
+        self._results = results
+        self._index = index
+
+    def __getitem__(self, key):
+        results = self._results
+        column = results._column_index[key]
+        return results._values[results._data[column][self._index]]
+
+    def __iter__(self):
+        return iter(self._results.columns)
+
+    def __len__(self):
+        return len(self._results.columns)
+
+    def values(self):
+        return self._results.get_row(self._index)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 class LibRdfResults(collections.Sequence):
-    results = None
+    """Sequence of query result rows
+
+    Rows are stored by column. Each distinct node is kept once in a value
+    table and the columns hold integer offsets into it, with 0 reserved for
+    unbound values. Indexing returns a ResultRow view instead of a dict.
+
+    With lazy=True rows are only pulled from the librdf result set as they
+    are accessed. Since librdf can't report how many rows a query will
+    produce, asking for the length of an unfinished lazy result re-runs the
+    query (when the query text and model are known) and counts the rows
+    without keeping them. Once write() has streamed the unread rows of a
+    lazy result to a file they are gone, and reading the results raises
+    ValueError.
+    """
     columns = None
-    def __init__(self, result_set):
+    stats = None
+    def __init__(self, result_set, lazy=False, query=None, model=None):
+        self._cursor = None
+        self._count = None
+        self._consumed = False
+        # only needed to count an unfinished lazy result, and holding on
+        # to the model would keep it alive as long as the results
+        self._query = query if lazy else None
+        self._model = model if lazy else None
+        self._values = [None]
+        self._codes = {None: 0}
+        self._data = []
+        self._column_index = {}
+        self._rows = 0
         if result_set is not None:
-            self.columns = self.get_bindings(result_set)
-            self.results = self.get_results(result_set)
+            self.set_columns(self.get_bindings(result_set))
+            if lazy:
+                self._result_set = result_set
+                self._cursor = iter(result_set)
+            else:
+                self.get_results(result_set)
+
+    @classmethod
+    def from_rows(cls, columns, rows, lazy=False):
+        """Make results from an iterable of dictionaries keyed by column
+        """
+        results = cls(None)
+        results.set_columns(columns)
+        results._cursor = iter(rows)
+        if not lazy:
+            results._fetch()
+        return results
+
+    def set_columns(self, columns):
+        self.columns = list(columns)
+        self._column_index = dict((c, i) for i, c in enumerate(self.columns))
+        self._data = [array.array('l') for c in self.columns]
 
     def get_bindings(self, result_set):
         b = []
@@ -93,52 +375,572 @@ class LibRdfResults(collections.Sequence):
         return b
 
     def get_results(self, result_set):
-        results = []
         for row in result_set:
-            record = [ row[k] for k in self.columns ]
-            results.append(record)
-        return results
+            self.append_row([row[k] for k in self.columns])
+
+    def append_row(self, values):
+        """Add a row of nodes, in column order
+        """
+        codes = self._codes
+        table = self._values
+        for column, value in zip(self._data, values):
+            key = node_key(value)
+            code = codes.get(key)
+            if code is None:
+                code = len(table)
+                codes[key] = code
+                table.append(value)
+            column.append(code)
+        self._rows += 1
+
+    def get_row(self, index):
+        """Return the nodes of a row as a list in column order
+        """
+        table = self._values
+        return [table[column[index]] for column in self._data]
+
+    @property
+    def results(self):
+        """All rows as lists of nodes"""
+        self._fetch()
+        return [self.get_row(i) for i in range(self._rows)]
+
+    def fetch(self, count=None):
+        """Read up to count more rows, or all of them, from the result set
+        """
+        self._fetch(None if count is None else self._rows + count)
+
+    @property
+    def fetched(self):
+        """How many rows have been read from the result set"""
+        return self._rows
+
+    @property
+    def exhausted(self):
+        """True once every row has been read from the result set"""
+        return self._cursor is None
+
+    @property
+    def consumed(self):
+        """True once write() has streamed rows that were never kept"""
+        return self._consumed
+
+    def _check_consumed(self):
+        if self._consumed:
+            raise ValueError(
+                "results were streamed to a file by write() and are no "
+                "longer available")
+
+    def _close_cursor(self):
+        """Let go of the result set and model once every row was read
+        """
+        self._cursor = None
+        self._result_set = None
+        self._query = None
+        self._model = None
+
+    def _fetch(self, stop=None):
+        """Pull rows from the result set until we have stop rows
+        """
+        self._check_consumed()
+        while self._cursor is not None and \
+              (stop is None or self._rows < stop):
+            try:
+                row = next(self._cursor)
+            except StopIteration:
+                self._close_cursor()
+                self._count = self._rows
+                break
+            self.append_row([row[k] for k in self.columns])
+
+    def _count_rows(self):
+        if self._query is None or self._model is None:
+            self._fetch()
+            return self._rows
+        count = 0
+        for row in RDF.SPARQLQuery(self._query).execute(self._model):
+            count += 1
+        return count
+
+    def _row_range(self, start, stop):
+        return [self.get_row(i) for i in range(start, stop)]
 
     def __getitem__(self, key):
-        return dict(zip(self.columns, self.results[key]))
+        if isinstance(key, slice):
+            if any(i is not None and i < 0 for i in (key.start, key.stop)):
+                self._fetch()
+            elif key.step is not None and key.step < 0:
+                # stepping backwards begins at start, or at the last row
+                self._fetch(None if key.start is None else key.start + 1)
+            else:
+                self._fetch(key.stop)
+            return [ResultRow(self, i)
+                    for i in range(*key.indices(self._rows))]
+        if key < 0:
+            self._fetch()
+            key += self._rows
+        else:
+            self._fetch(key + 1)
+        if key < 0 or key >= self._rows:
+            raise IndexError("result row out of range")
+        return ResultRow(self, key)
+
+    def __iter__(self):
+        i = 0
+        while True:
+            self._fetch(i + 1)
+            if i >= self._rows:
+                return
+            yield ResultRow(self, i)
+            i += 1
 
     def __len__(self):
-        return len(self.results)
+        self._check_consumed()
+        if self._cursor is None:
+            return self._rows
+        if self._count is None:
+            self._count = self._count_rows()
+        return self._count
+
+    def display_window(self):
+        """Return head rows, tail rows, and how many rows were left out
+
+        Shows at most display.max_rows rows, split between the start and the
+        end of the results. Unfinished lazy results only show the head so
+        the rest of the result set doesn't need to be read, and since their
+        length isn't known yet the number of rows left out is None.
+        """
+        max_rows = get_option('display.max_rows')
+        self._check_consumed()
+        if self._cursor is not None:
+            # one extra row tells us whether there is more to show
+            self._fetch(max_rows + 1)
+            if self._cursor is not None:
+                return self._row_range(0, max_rows), [], None
+        total = self._rows
+        if total <= max_rows:
+            return self._row_range(0, total), [], 0
+        head = max_rows - max_rows // 2
+        tail = max_rows // 2
+        return (self._row_range(0, head),
+                self._row_range(total - tail, total),
+                total - head - tail)
+
+    def _typed_column(self, index):
+        """Convert one column in bulk
+
+        Each distinct node used by the column is converted once, and the
+        converted values are spread out to the rows with numpy indexing.
+
+        returns (kind, values, mask) where mask marks unbound rows. For uri
+        columns values is a tuple of category codes and category names.
+        """
+        import numpy
+        self._fetch()
+        column = self._data[index]
+        codes = numpy.array(column, dtype=numpy.int64)
+        unique = numpy.unique(codes)
+        positions = numpy.searchsorted(unique, codes)
+        mask = codes == 0
+        if len(unique) and unique[0] == 0:
+            unique = unique[1:]
+            positions = positions - 1
+        nodes = [self._values[c] for c in unique]
+        kinds = set(node_kind(n) for n in nodes)
+        kind = kinds.pop() if len(kinds) == 1 else 'string'
+
+        if kind == 'uri':
+            categories = [str(n.uri) for n in nodes]
+            return kind, (positions, categories), mask
+
+        texts = [str(n) for n in nodes]
+        try:
+            if kind == 'integer':
+                converted = numpy.array([int(t) for t in texts], dtype=numpy.int64)
+            elif kind == 'float':
+                converted = numpy.array([float(t) for t in texts], dtype=numpy.float64)
+            elif kind == 'boolean':
+                converted = numpy.array([t.strip() in ('true', '1') for t in texts],
+                                        dtype=bool)
+            elif kind == 'datetime':
+                converted = numpy.array([t.rstrip('Z') for t in texts],
+                                        dtype='datetime64[ns]')
+            else:
+                converted = numpy.array(texts, dtype=object)
+        except ValueError:
+            kind = 'string'
+            converted = numpy.array(texts, dtype=object)
+        if len(converted) == 0:
+            return kind, numpy.empty(len(codes), dtype=converted.dtype), mask
+        # unbound rows point at a placeholder that is masked out
+        values = converted[numpy.clip(positions, 0, None)]
+        return kind, values, mask
+
+    def _numpy_column(self, kind, values, mask):
+        """Turn a column from _typed_column into one numpy array
+        """
+        import numpy
+        if kind == 'uri':
+            positions, categories = values
+            names = numpy.array(categories + [None], dtype=object)
+            return names[numpy.where(mask, len(categories), positions)]
+        if mask.any():
+            if kind == 'integer':
+                values = values.astype(numpy.float64)
+            elif kind == 'boolean':
+                values = values.astype(object)
+            if kind in ('integer', 'float'):
+                values[mask] = numpy.nan
+            elif kind == 'datetime':
+                values[mask] = numpy.datetime64('NaT')
+            else:
+                values[mask] = None
+        return values
+
+    def to_numpy(self):
+        """Return results as a numpy structured array with typed columns
+
+        Requires numpy.
+        """
+        import numpy
+        arrays = [self._numpy_column(*self._typed_column(i))
+                  for i in range(len(self.columns))]
+        dtype = [(str(name), a.dtype) for name, a in zip(self.columns, arrays)]
+        records = numpy.empty(len(self), dtype=dtype)
+        for name, values in zip(self.columns, arrays):
+            records[str(name)] = values
+        return records
+
+    def to_dataframe(self):
+        """Return results as a pandas DataFrame
+
+        URIs become categorical columns and XSD typed literals become
+        native dtypes. Requires pandas.
+        """
+        import pandas
+        data = collections.OrderedDict()
+        for i, name in enumerate(self.columns):
+            kind, values, mask = self._typed_column(i)
+            if kind == 'uri':
+                positions, categories = values
+                positions = positions.copy()
+                positions[mask] = -1
+                data[name] = pandas.Categorical.from_codes(
+                    positions, categories=categories)
+            else:
+                data[name] = self._numpy_column(kind, values, mask)
+        return pandas.DataFrame(data, columns=self.columns)
+
+    def to_arrow(self):
+        """Return results as a pyarrow Table
+
+        URIs become dictionary encoded columns. Requires pyarrow.
+        """
+        import pyarrow
+        arrays = []
+        for i in range(len(self.columns)):
+            kind, values, mask = self._typed_column(i)
+            if kind == 'uri':
+                positions, categories = values
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(positions, type=pyarrow.int32(), mask=mask),
+                    pyarrow.array(categories, type=pyarrow.string())))
+            elif kind == 'string':
+                arrays.append(pyarrow.array(values, type=pyarrow.string(),
+                                            mask=mask))
+            else:
+                arrays.append(pyarrow.array(values, mask=mask))
+        return pyarrow.Table.from_arrays(arrays, names=list(self.columns))
+
+    def write(self, pathname, format=None, curies=False, batch_size=None):
+        """Write the results to a tsv, csv, jsonl or parquet file
+
+        The format is guessed from the file extension if not given, and
+        text formats may be compressed like sources. Rows that haven't
+        been read from a lazy result set yet are streamed to the file
+        batch_size at a time without being kept, so memory use doesn't
+        grow with the number of rows. If any were, the results can't be
+        read afterwards.
+
+        With curies URIs are shortened with the known prefixes, as in
+        the display.
+
+        returns the number of rows written
+        """
+        self._check_consumed()
+        if batch_size is None:
+            batch_size = get_option('export.batch_size')
+
+        def batches():
+            fetched = self._rows
+            for start in range(0, fetched, batch_size):
+                yield [format_export_row(self.get_row(i), curies)
+                       for i in range(start, min(start + batch_size, fetched))]
+            batch = []
+            while self._cursor is not None:
+                try:
+                    row = next(self._cursor)
+                except StopIteration:
+                    self._close_cursor()
+                    break
+                self._consumed = True
+                batch.append(format_export_row(
+                    [row[k] for k in self.columns], curies))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        return export_rows(pathname, self.columns, batches(), format)
+
+    def page_count(self, page_size=None):
+        if page_size is None:
+            page_size = get_option('display.max_rows')
+        return max(1, (len(self) + page_size - 1) // page_size)
+
+    def page(self, number, page_size=None):
+        """Return one page of results, counting from 0
+
+        Only the rows on the page are read and formatted. The page size
+        defaults to display.max_rows.
+        """
+        if page_size is None:
+            page_size = get_option('display.max_rows')
+        start = number * page_size
+        self._fetch(start + page_size)
+        if number < 0 or (number > 0 and start >= self._rows):
+            raise IndexError("page {0} is out of range".format(number))
+        rows = self._row_range(start, min(start + page_size, self._rows))
+        return ResultsPage(self, number, page_size, rows)
+
+    def pager(self, page_size=None):
+        """Return an ipywidgets browser that renders one page at a time
+
+        Unfinished lazy results aren't counted, the last page that can be
+        chosen moves forward as pages are read until every row has been.
+
+        Requires ipywidgets.
+        """
+        import ipywidgets
+        if page_size is None:
+            page_size = get_option('display.max_rows')
+        output = ipywidgets.HTML()
+        selector = ipywidgets.BoundedIntText(
+            value=1, min=1, max=1, description='Page')
+
+        def show(change=None):
+            output.value = self.page(selector.value - 1, page_size)._repr_html_()
+            # one row past the page tells whether there is another one
+            self._fetch(selector.value * page_size + 1)
+            if self.exhausted:
+                selector.max = self.page_count(page_size)
+            else:
+                selector.max = max(selector.max, selector.value + 1)
+        selector.observe(show, names='value')
+        show()
+        return ipywidgets.VBox([selector, output])
 
     def generate_html(self):
-        result_set = iter(self)
-        yield '<table><tr>'
-        for c in self.columns:
-            yield "<td>{0}</td>".format(str(c))
-        yield '</tr>'
-        for row in self:
-            yield '<tr>'
-            for key in self.columns:
-                value = row[key]
-                yield '<td>'
-                yield display_node(value, mime_type='text/html')
-                yield '</td>'
-            yield '</tr>'
-        yield '</table>'
+        head, tail, hidden = self.display_window()
+        footer = None
+        if hidden is None:
+            footer = '... more rows, use .page(n) to see them'
+        elif hidden:
+            footer = '... {0} more rows, use .page(n) to see them'.format(hidden)
+        return generate_html_table(self.columns, head, tail, footer)
 
     def _repr_html_(self):
-        return "".join(self.generate_html())
+        with (self.stats or _null_stats).phase('render'):
+            return "".join(self.generate_html())
 
     def __str__(self):
-        result_set = iter(self)
+        with (self.stats or _null_stats).phase('render'):
+            return self._format_text()
+
+    def _format_text(self):
+        head, tail, hidden = self.display_window()
         output = []
         output.append("\t".join(self.columns))
-        for row in self.results:
-            ordered = (display_node(value, mime_type='text/plain')
-                       for value in row)
-            output.append("\t".join(ordered))
+        for row in head:
+            output.append(format_text_row(row))
+        if hidden is None:
+            output.append("... more rows")
+        elif hidden:
+            output.append("... {0} more rows".format(hidden))
+        for row in tail:
+            output.append(format_text_row(row))
+        return os.linesep.join(output)
+
+
+class ResultsPage(object):
+    """One page of a LibRdfResults
+    """
+    def __init__(self, results, number, page_size, rows):
+        self.results = results
+        self.number = number
+        self.page_size = page_size
+        self.rows = rows
+
+    def summary(self):
+        start = self.number * self.page_size
+        if not self.results.exhausted:
+            # counting the rows would mean running the query again
+            return 'rows {0}-{1}, page {2}, more rows follow'.format(
+                start + 1, start + len(self.rows), self.number + 1)
+        return 'rows {0}-{1} of {2}, page {3} of {4}'.format(
+            start + 1, start + len(self.rows), len(self.results),
+            self.number + 1, self.results.page_count(self.page_size))
+
+    def _repr_html_(self):
+        return "".join(generate_html_table(
+            self.results.columns, self.rows, [], self.summary()))
+
+    def __str__(self):
+        output = ["\t".join(self.results.columns)]
+        output.extend(format_text_row(row) for row in self.rows)
+        output.append(self.summary())
         return os.linesep.join(output)
 
+
+def generate_html_table(columns, head, tail, footer=None):
+    """Yield pieces of an html table with an optional marker after head
+    """
+    yield '<table><tr>'
+    for c in columns:
+        yield "<td>{0}</td>".format(str(c))
+    yield '</tr>'
+    for row in head:
+        yield format_html_row(row)
+    if footer:
+        yield '<tr><td colspan="{0}">{1}</td></tr>'.format(
+            len(columns), footer)
+    for row in tail:
+        yield format_html_row(row)
+    yield '</table>'
+
+def format_html_row(row):
+    cells = ('<td>{0}</td>'.format(display_node(value, mime_type='text/html'))
+             for value in row)
+    return '<tr>' + ''.join(cells) + '</tr>'
+
+def format_text_row(row):
+    return "\t".join(display_node(value, mime_type='text/plain')
+                     for value in row)
+
+def export_value(node, curies=False):
+    """Return the text of a node for export, or None when unbound
+    """
+    if node is None:
+        return None
+    if isinstance(node, RDF.Node):
+        if node.is_resource():
+            uri = str(node.uri)
+            return _namespace_index.shorten(uri) if curies else uri
+        elif node.is_blank():
+            value = '_:' + node.blank_identifier
+        else:
+            value = node.literal_value['string']
+    else:
+        value = node
+    if isinstance(value, six.binary_type):
+        return value.decode('utf-8')
+    return six.text_type(value)
+
+def format_export_row(row, curies=False):
+    return [export_value(value, curies) for value in row]
+
+EXPORT_FORMATS = ('tsv', 'csv', 'jsonl', 'parquet')
+
+def guess_export_format(pathname):
+    base, _ = split_compression(pathname)
+    ext = os.path.splitext(base)[1].lower().lstrip('.')
+    if ext == 'ndjson':
+        ext = 'jsonl'
+    if ext not in EXPORT_FORMATS:
+        raise ValueError("Can't guess export format of {0}".format(pathname))
+    return ext
+
+def _escape_tsv(value):
+    if value is None:
+        return ''
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+                .replace('\n', '\\n').replace('\r', '\\r')
+
+def _escape_csv(value):
+    if value is None:
+        return ''
+    if any(c in value for c in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+def export_rows(pathname, columns, batches, format=None):
+    """Write batches of rows of strings to pathname
+
+    returns the number of rows written
+    """
+    if format is None:
+        format = guess_export_format(pathname)
+    _, compression = split_compression(pathname)
+    if format == 'parquet':
+        if compression is not None:
+            raise ValueError(
+                "parquet files are compressed internally, "
+                "write {0} without the compression suffix".format(pathname))
+        return _export_parquet(pathname, columns, batches)
+    elif format == 'tsv':
+        def encode(row):
+            return '\t'.join(_escape_tsv(v) for v in row)
+    elif format == 'csv':
+        def encode(row):
+            return ','.join(_escape_csv(v) for v in row)
+    elif format == 'jsonl':
+        def encode(row):
+            return json.dumps(collections.OrderedDict(zip(columns, row)),
+                              ensure_ascii=False)
+    else:
+        raise ValueError("Unknown export format {0}".format(format))
+
+    count = 0
+    with open_compressed(pathname, compression, 'wb') as outstream:
+        if format != 'jsonl':
+            outstream.write((encode(columns) + '\n').encode('utf-8'))
+        for batch in batches:
+            lines = [encode(row) for row in batch]
+            lines.append('')
+            outstream.write('\n'.join(lines).encode('utf-8'))
+            count += len(batch)
+    return count
+
+def _export_parquet(pathname, columns, batches):
+    """Write each batch as a parquet row group of string columns
+
+    Requires pyarrow.
+    """
+    import pyarrow
+    import pyarrow.parquet
+    schema = pyarrow.schema([(c, pyarrow.string()) for c in columns])
+    count = 0
+    writer = pyarrow.parquet.ParquetWriter(pathname, schema)
+    try:
+        for batch in batches:
+            arrays = [pyarrow.array([row[i] for row in batch],
+                                    type=pyarrow.string())
+                      for i in range(len(columns))]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            count += len(batch)
+    finally:
+        writer.close()
+    return count
+
 @magics_class
 class SPARQLMagics(Magics):
     SUPPORT_FROM = False
     def __init__(self, shell):
         super(SPARQLMagics, self).__init__(shell)
+        self.models = ModelRegistry()
+        self.query_cache = QueryCache()
+        self.stores = {}
 
     @magic_arguments()
     @argument('prefix', nargs=1, type=str,
@@ -152,8 +954,14 @@ class SPARQLMagics(Magics):
             raise UsageError("Please specify prefix and namespace")
         namespace = args.namespace[0]
         prefix = args.prefix[0]
+        if prefix in _prefixes:
+            old = _prefixes[prefix]
+            _namespaces.pop(old, None)
+            _namespace_index.remove(old)
         _namespaces[namespace] = prefix
         _prefixes[prefix] = namespace
+        _namespace_index.add(namespace, prefix)
+        reset_prefix_header()
         self.shell.user_ns[prefix] = RDF.NS(namespace)
 
     @line_magic
@@ -177,17 +985,17 @@ class SPARQLMagics(Magics):
 
         name = args.name[0]
         if name in _prefixes:
-            del _namespaces[self._prefixes[name]]
-            del _prefixes[name]
-            del self.shell.user_ns[name]
+            prefix, namespace = name, _prefixes[name]
         elif name in _namespaces:
-            prefix = self._namespaces[name]
-            del _prefixes[prefix]
-            del _namespaces[name]
-            del self.shell.user_ns[prefix]
+            prefix, namespace = _namespaces[name], name
         else:
             raise UsageError("%s was not found in our namespace cache" % (
                 name,))
+        del _prefixes[prefix]
+        del _namespaces[namespace]
+        _namespace_index.remove(namespace)
+        reset_prefix_header()
+        self.shell.user_ns.pop(prefix, None)
 
     @magic_arguments()
     @argument('-D', '--data', default=None, type=str,
@@ -200,24 +1008,132 @@ class SPARQLMagics(Magics):
               default=None,
               help="Specifiy variable to hold output")
     @line_cell_magic
-    def roqet(self, line, cell):
-        """Call libRDF roqet utility"""
-        pass
+    def roqet(self, line, cell=None):
+        """Run a query like the roqet utility
+
+        With -p the query is sent to a SPARQL Protocol service, otherwise
+        it runs against the model and data source like %%sparql.
+        """
+        arg = parse_argstring(self.roqet, line)
+        if cell is None:
+            raise UsageError("Please provide a query")
+        options = []
+        if arg.protocol is not None:
+            options.extend(['--endpoint', arg.protocol])
+        if arg.model is not None:
+            options.extend(['-m', arg.model])
+        if arg.data is not None:
+            options.extend(['-s', arg.data])
+        if arg.output is not None:
+            options.extend(['-o', arg.output])
+        return self.sparql(' '.join(options), cell)
 
     @magic_arguments()
     @argument('-m', '--model', default=None,
               help="use specified variable as the model to store "\
-                   "intermediate results in.")
+                   "intermediate results in. With --federate a comma "\
+                   "separated list of models")
+    @argument('--federate', default=False, action='store_true',
+              help="run the query against each model and source separately "\
+                   "and merge the results")
     @argument('-o', '--output', type=str, default=None,
               help="Specifiy variable to hold output")
     @argument('-s', '--source', default=None,
               help="Source can be a literal, a python string, or python list")
     @argument('-c', '--count', default=False, action="store_true",
               help="output count of rows returned")
+    @argument('-j', '--jobs', type=int, default=None,
+              help="number of sources to load at the same time")
+    @argument('--lazy', default=None, action='store_true',
+              help="only read result rows as they are used")
+    @argument('-e', '--endpoint', default=None,
+              help="send the query to a SPARQL Protocol service url")
+    @argument('--no-cache', dest='use_cache', default=True,
+              action='store_false',
+              help="always run the query instead of reusing earlier results")
+    @argument('--as', dest='output_as', default='results',
+              choices=['results', 'dataframe', 'numpy', 'arrow'],
+              help="convert results to a pandas, numpy or arrow table")
+    @argument('--background', default=False, action='store_true',
+              help="run the query on a worker thread and return a job handle")
+    @argument('--profile', default=False, action='store_true',
+              help="report time spent loading, querying and rendering")
+    @argument('--export', default=None,
+              help="stream the results to a .tsv, .csv, .jsonl or "\
+                   ".parquet file instead of returning them")
+    @argument('--curies', default=False, action='store_true',
+              help="shorten URIs with the known prefixes when exporting")
+    @argument('--into', default=None,
+              help="add the graph from a CONSTRUCT or DESCRIBE query to "\
+                   "the model in this variable, making it if needed")
+    @argument('--bind', default=None,
+              help="run the query for the rows of earlier results held "\
+                   "in this variable, passed in VALUES blocks")
+    @argument('--template', default=None,
+              help="store the query as a template with $name parameters "\
+                   "in this variable instead of running it")
     @cell_magic
     def sparql(self, line, cell=None):
         arg = parse_argstring(self.sparql, line)
+        if arg.template is not None:
+            return self._make_template(arg, cell)
+        if arg.background:
+            if arg.output is None:
+                raise UsageError("Please specify -o to hold background results")
+            job = QueryJob(arg.output)
+            job.start(get_background_executor(), self._run_sparql, arg, cell, job)
+            return job
+        return self._run_sparql(arg, cell)
+
+    def _run_sparql(self, arg, cell, job=None):
+        """Load sources, run the query and handle its results
+
+        If a QueryJob is given its progress is updated and it is checked
+        for cancellation between steps.
+        """
+        stats = None
+        if arg.profile or get_option('profile.enabled') or _stats_hooks:
+            stats = QueryStats()
+            stats.start()
+
+        if arg.federate and (arg.bind is not None or arg.into is not None):
+            raise UsageError("--bind and --into can't be used with --federate")
+
+        bindings = None
+        if arg.bind is not None:
+            bindings = self.shell.user_ns.get(arg.bind)
+            if not isinstance(bindings, LibRdfResults):
+                raise UsageError("{0} doesn't hold query results".format(arg.bind))
+
+        target = None
+        if arg.into is not None:
+            target = self.shell.user_ns.get(arg.into)
+            if target is None:
+                target = make_temp_model()
+                self.shell.user_ns[arg.into] = target
+            elif not isinstance(target, RDF.Model):
+                raise UsageError("{0} is not an RDF.Model".format(arg.into))
+
+        if arg.endpoint is not None:
+            endpoint = self.shell.user_ns.get(arg.endpoint, arg.endpoint)
+            if target is not None:
+                with (stats or _null_stats).phase('query'):
+                    added = query_endpoint_graph(
+                        endpoint, prepare_query(cell), target)
+                return self._finish_graph(arg, target, added, stats)
+            with (stats or _null_stats).phase('query'):
+                if bindings is not None:
+                    try:
+                        results = run_bound_query(
+                            prepare_query(cell), bindings,
+                            lambda query: query_endpoint(endpoint, query))
+                    except ValueError as e:
+                        raise UsageError(str(e))
+                else:
+                    results = query_endpoint(endpoint, prepare_query(cell))
+            return self._finish_results(arg, results, stats)
 
+        sources = []
         if cell is not None:
             sources, cell = extract_froms(cell)
 
@@ -227,21 +1143,179 @@ class SPARQLMagics(Magics):
         if arg.model is None and len(sources) == 0:
             raise UsageError("Please specify a source to query against.")
 
-        model = self._get_model(arg.model)
-
+        sources = [normalize_source(s) for s in sources]
         for source in sources:
             if source.startswith("tracker:"):
-                raise NotImplemented("Tracker queries not implemented yet")
-            else:
-                load_source(model, source)
+                raise NotImplementedError("Tracker queries not implemented yet")
 
+        if arg.federate:
+            return self._run_federated(arg, cell, sources, job, stats)
+        if arg.model is not None and ',' in arg.model:
+            raise UsageError("Use --federate to query several models")
+
+        if arg.model is None:
+            model = self.models.get_temp_model(sources)
+        else:
+            model = self._get_model(arg.model)
+        if target is model:
+            # the results are read from model while they are being added
+            raise UsageError(
+                "--into {0} is the model being queried".format(arg.into))
+        # a librdf model is only used by one thread at a time, background
+        # jobs could otherwise load into or query it alongside the kernel
+        with self.models.load_lock(model):
+            self._load_sources(model, sources, arg.jobs, job, stats)
+            return self._query_model(arg, cell, model, sources, bindings,
+                                     target, job, stats)
+
+    def _query_model(self, arg, cell, model, sources, bindings, target,
+                     job=None, stats=None):
+        """Run the query against a loaded model and handle its results
+        """
         body = prepare_query(cell)
-        query = RDF.SPARQLQuery(body)
-        results = LibRdfResults(query.execute(model))
+        if target is not None:
+            with (stats or _null_stats).phase('query'):
+                try:
+                    added = add_graph_results(
+                        target, RDF.SPARQLQuery(body).execute(model))
+                except ValueError as e:
+                    raise UsageError(str(e))
+            return self._finish_graph(arg, target, added, stats)
+
+        if bindings is not None:
+            def execute(query):
+                if job is not None:
+                    job.check()
+                return LibRdfResults(RDF.SPARQLQuery(query).execute(model))
+            with (stats or _null_stats).phase('query'):
+                try:
+                    results = run_bound_query(body, bindings, execute)
+                except ValueError as e:
+                    raise UsageError(str(e))
+            return self._finish_results(arg, results, stats)
+
+        key = None
+        entry = self.models.entry(model)
+        # exports stream rows away, a cached result would be left empty
+        if arg.use_cache and entry is not None and arg.export is None:
+            key = self.query_cache.make_key(body, sources, model, entry)
+        results = self.query_cache.get(key)
+        timer = stats or _null_stats
+        if results is not None:
+            timer.set('cache_hit', True)
+        else:
+            query = RDF.SPARQLQuery(body)
+            lazy = arg.lazy if arg.lazy is not None else get_option('results.lazy')
+            if job is not None:
+                job.check()
+                lazy = True
+            if arg.export is not None:
+                # stream the rows to the file instead of keeping them
+                lazy = True
+            with timer.phase('query'):
+                result_set = query.execute(model)
+            with timer.phase('results'):
+                results = LibRdfResults(result_set, lazy=lazy,
+                                        query=body, model=model)
+                if job is not None and arg.export is None:
+                    while not results.exhausted:
+                        job.check()
+                        results.fetch(1000)
+                        job.progress['rows_fetched'] = results.fetched
+            self.query_cache.put(key, results)
+        return self._finish_results(arg, results, stats)
+
+    def _run_federated(self, arg, cell, sources, job=None, stats=None):
+        """Query each model, and a model per source, and merge the results
+        """
+        partitions = []
+        if arg.model is not None:
+            for name in arg.model.split(','):
+                partitions.append(self._get_model(name.strip()))
+        for source in sources:
+            model = self.models.get_temp_model([source])
+            self._load_sources(model, [source], arg.jobs, job, stats)
+            partitions.append(model)
+        if job is not None:
+            job.check()
+        lazy = arg.lazy if arg.lazy is not None else get_option('results.lazy')
+        if arg.export is not None:
+            lazy = True
+        # taken in a fixed order so two federated jobs can't deadlock
+        locks = sorted(set(self.models.load_lock(m) for m in partitions),
+                       key=id)
+        for lock in locks:
+            lock.acquire()
+        try:
+            with (stats or _null_stats).phase('query'):
+                try:
+                    results = federate_query(prepare_query(cell), partitions,
+                                             lazy)
+                except ValueError as e:
+                    raise UsageError(str(e))
+            return self._finish_results(arg, results, stats)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _make_template(self, arg, cell):
+        """Compile cell into a SparqlTemplate stored in the user namespace
+        """
+        if cell is None:
+            raise UsageError("Please provide a query")
+        endpoint = None
+        if arg.endpoint is not None:
+            endpoint = self.shell.user_ns.get(arg.endpoint, arg.endpoint)
+        model = None
+        if arg.model is not None:
+            model = self._get_model(arg.model)
+        source = self.shell.user_ns.get(arg.source, arg.source)
+        sources = self._parse_source(source)
+        template = SparqlTemplate(cell, model, sources, endpoint)
+        if model is not None:
+            self._load_sources(model, template.sources, arg.jobs)
+        self.shell.user_ns[arg.template] = template
+        return template
+
+    def _finish_graph(self, arg, target, added, stats=None):
+        """Report on statements added to the --into model
+        """
+        self.models.touch(target)
+        if stats is not None:
+            stats.finish()
+            stats.set('statements', added)
+            if arg.profile:
+                print (stats)
+        print ("Added {0} statements to {1}".format(added, arg.into))
+
+    def _finish_results(self, arg, results, stats=None):
+        """Report, convert and store results as requested by the arguments
+        """
+        if arg.export is not None and isinstance(results, LibRdfResults):
+            with (stats or _null_stats).phase('export'):
+                count = results.write(arg.export, curies=arg.curies)
+            print ("Wrote {0} rows to {1}".format(count, arg.export))
+            if stats is not None:
+                stats.finish(results)
+                stats.set('rows', count)
+                if arg.profile:
+                    print (stats)
+            return
+
+        if stats is not None:
+            stats.finish(results)
+            if isinstance(results, LibRdfResults):
+                results.stats = stats
+            if arg.profile:
+                print (stats)
+
+        if isinstance(results, LibRdfResults):
+            if arg.count:
+                print ("Found {0} rows.".format(len(results)))
+
+            if arg.output_as != 'results':
+                results = getattr(results, 'to_' + arg.output_as)()
 
-        if arg.count:
-            print ("Found {0} rows.".format(len(results)))
-            
         if arg.output is None:
             return results
         else:
@@ -251,6 +1325,11 @@ class SPARQLMagics(Magics):
     @argument('-m', '--model', default=None,
               help="use specified variable as the model to store "\
                    "intermediate results in.")
+    @argument('-j', '--jobs', type=int, default=None,
+              help="number of sources to load at the same time")
+    @argument('--refresh', default=False, action='store_true',
+              help="reload sources that changed, all of the model's "\
+                   "sources if none are listed")
     @argument('sources', nargs='*', default=None,
               help="Source can be a literal, a python string, or python list")
     @line_magic
@@ -264,22 +1343,174 @@ class SPARQLMagics(Magics):
                 source = self.shell.user_ns.get(variable_name, variable_name)
                 sources.extend(self._parse_source(source))
 
-        for s in sources:
-            load_source(model, s)
+        if arg.refresh:
+            if not supports_contexts(model):
+                raise UsageError(
+                    "Refreshing needs a model with contexts, such as one "
+                    "from %rdfmodel or make_temp_model(contexts=True)")
+            if not sources:
+                sources = self.models.sources(model)
+
+        self._load_sources(model, sources, arg.jobs, refresh=arg.refresh)
 
         if arg.model is not None:
             return model
 
+    @magic_arguments()
+    @argument('--drop', default=False, action='store_true',
+              help="forget the listed models, or all temporary models")
+    @argument('names', nargs='*', default=None,
+              help="model variables or temporary model names")
+    @line_magic
+    def rdfmodels(self, line):
+        """List models and the sources loaded into them"""
+        arg = parse_argstring(self.rdfmodels, line)
+        if arg.drop:
+            self.models.drop(arg.names)
+            return
+
+        for entry in self.models.entries():
+            if arg.names and entry.name not in arg.names:
+                continue
+            print ("{0} ({1} triples, generation {2})".format(
+                entry.name, len(entry.model), entry.generation))
+            for source in entry.sources:
+                print ("  {0}".format(source))
+
+    @magic_arguments()
+    @argument('name', help="model variable or temporary model name")
+    @argument('--top', type=int, default=10,
+              help="how many predicates and classes to list")
+    @argument('--void', default=None,
+              help="write a VoID description of the model to this file")
+    @line_magic
+    def rdfstats(self, line):
+        """Show statistics collected while loading a model's sources"""
+        arg = parse_argstring(self.rdfstats, line)
+        entry = self.models.find(arg.name)
+        if entry is None:
+            raise UsageError("No model named {0}".format(arg.name))
+        if not entry.stats:
+            raise UsageError("No statistics for {0}, set load.stats to "
+                             "collect them while loading".format(arg.name))
+        summary = DatasetStats.merged(entry.stats.values())
+        if arg.void is not None:
+            dataset = 'file://' + os.path.abspath(arg.void) + '#' + entry.name
+            save_model(summary.to_void(dataset, entry.stats.keys()), arg.void)
+            return
+
+        print (summary.format(arg.top))
+        print ("sources:")
+        for source, source_stats in entry.stats.items():
+            print ("  {0} {1}".format(source_stats.triples, source))
+        print ("namespaces:")
+        for namespace, count in summary.namespaces().most_common():
+            prefix = _namespaces.get(namespace, '')
+            print ("  {0} {1} {2}".format(count, namespace, prefix))
+
+    @magic_arguments()
+    @argument('action', choices=['create', 'open', 'close', 'list'],
+              help="what to do with the on-disk model")
+    @argument('name', nargs='?', default=None,
+              help="variable to hold the model")
+    @argument('--storage', default='hashes', choices=STORAGE_TYPES,
+              help="librdf storage type")
+    @argument('--path', default=None,
+              help="directory for hashes storage, database file for sqlite")
+    @line_magic
+    def rdfmodel(self, line):
+        """Create, open, or close models kept on disk"""
+        arg = parse_argstring(self.rdfmodel, line)
+        if arg.action == 'list':
+            for key, (name, model) in sorted(self.stores.items()):
+                print ("{0} {1} {2}".format(name, key[0], key[1]))
+            return
+        if arg.name is None:
+            raise UsageError("Please specify a model name")
+
+        if arg.action == 'close':
+            for key, (name, model) in list(self.stores.items()):
+                if name == arg.name:
+                    del self.stores[key]
+                    model.sync()
+                    self.shell.user_ns.pop(name, None)
+                    self.models.drop([name])
+            return
+
+        path = arg.path
+        if path is None:
+            path = os.getcwd() if arg.storage == 'hashes' else arg.name + '.sqlite'
+        key = (arg.storage, os.path.abspath(path), arg.name)
+        if key in self.stores and arg.action == 'create':
+            raise UsageError("{0} is already open".format(arg.name))
+        if key in self.stores:
+            # reuse the open handle, librdf can't open a store twice
+            name, model = self.stores[key]
+        else:
+            try:
+                model, sources_file = open_model(
+                    arg.storage, key[1], arg.name,
+                    create=arg.action == 'create')
+            except (IOError, ValueError) as e:
+                raise UsageError(str(e))
+            self.stores[key] = (arg.name, model)
+            self.models.register(model, arg.name, sources_file)
+        self.shell.user_ns[arg.name] = model
+
     def _get_model(self, variable):
         """Get model from user name space, or make a new one"""
         if variable is not None:
             m = self.shell.user_ns.get(variable)
             if not isinstance(m, RDF.Model):
                 raise ValueError("Model needs to be RDF.Model")
+            self.models.register(m, variable)
         else:
             m = make_temp_model()
         return m
 
+    def _load_sources(self, model, sources, jobs=None, job=None, stats=None,
+                      refresh=False):
+        """Load sources into model, skipping ones that are already present
+
+        If the model supports contexts each source is kept in its own, and
+        a source that changed replaces its old triples instead of adding
+        to them. Remote sources are only checked for changes when
+        refreshing, against the validator they were loaded with. Sources
+        that fail to load are reported without stopping the rest.
+        """
+        # two background jobs may want the same sources in the same model
+        with self.models.load_lock(model):
+            contexts = supports_contexts(model)
+            pending = collections.OrderedDict()
+            for source in sources:
+                source = normalize_source(source)
+                version = source_version(source, remote=refresh)
+                if self.models.is_loaded(model, source, version):
+                    continue
+                pending[source] = version
+
+            if job is not None:
+                job.progress['sources_total'] = len(pending)
+                def callback(source):
+                    job.progress['sources_loaded'] += 1
+                    job.check()
+            else:
+                callback = None
+            summaries = {} if get_option('load.stats') else None
+            validators = {}
+            errors = load_sources(model, list(pending.keys()), jobs, callback,
+                                  stats, contexts, summaries, validators)
+            for source, version in pending.items():
+                if source in errors:
+                    print ("Unable to load {0}: {1}".format(
+                        source, errors[source]), file=sys.stderr)
+                else:
+                    if version is None:
+                        version = validators.get(source)
+                    summary = summaries.get(source) if summaries is not None else None
+                    self.models.record(model, source, version, summary=summary)
+            return errors
+
     def _parse_source(self, source):
         """parse a source argument and return a list of sources
         """
@@ -301,24 +1532,88 @@ class SPARQLMagics(Magics):
     @argument('-m', '--model', default=None,
               help="use specified variable as the model to store "\
                    "intermediate results in.")
-    @argument('-f', '--format', default='turtle',
-              help="Specify format to save model as")
+    @argument('-f', '--format', default=None,
+              help="Specify format to save model as, otherwise it is "\
+                   "guessed from the file extension")
     @argument('filename', nargs=1, type=str, help="filename to save model as")
     @line_magic
     def save_model(self, line):
-        arg = parse_argstring(self.load_source, line)
+        """Serialize a model to a file
+
+        .gz, .bz2, .xz and .zst extensions compress the output.
+        """
+        arg = parse_argstring(self.save_model, line)
+        if arg.model is None:
+            raise UsageError("Please specify a model to save")
         model = self._get_model(arg.model)
-        if model is None:
-            UsageError("Please specify a model to save")
+        save_model(model, arg.filename[0], arg.format)
+
+    @magic_arguments()
+    @argument('action', nargs='?', default='stats',
+              choices=['stats', 'purge', 'pin', 'unpin'],
+              help="what to do with the source cache")
+    @argument('sources', nargs='*', default=None,
+              help="sources to purge, pin, or unpin")
+    @argument('--all', default=False, action='store_true',
+              help="purge pinned sources too")
+    @line_magic
+    def rdfcache(self, line):
+        """Manage the on-disk source cache and the query result cache"""
+        arg = parse_argstring(self.rdfcache, line)
+        cache = get_source_cache()
+
+        if arg.action == 'stats':
+            print ("query results:")
+            for key, value in sorted(self.query_cache.stats().items()):
+                print ("  {0:10} {1}".format(key, value))
+            if cache is not None:
+                print ("sources:")
+                for key, value in sorted(cache.stats().items()):
+                    print ("  {0:10} {1}".format(key, value))
+            return
+
+        if arg.action == 'purge':
+            if not arg.sources:
+                self.query_cache.clear()
+            if cache is not None:
+                cache.purge(arg.sources, include_pinned=arg.all)
+        elif cache is None:
+            raise UsageError("The source cache is disabled")
+        else:
+            if not arg.sources:
+                raise UsageError("Please specify sources to {0}".format(
+                    arg.action))
+            for source in arg.sources:
+                try:
+                    cache.pin(source, pinned=arg.action == 'pin')
+                except KeyError as e:
+                    raise UsageError(str(e))
 
-        if arg.filename is None:
-            UsageError("Please specify a destination")
+    @magic_arguments()
+    @argument('name', nargs='?', default=None, help="option name")
+    @argument('value', nargs='?', default=None, help="new value")
+    @line_magic
+    def rdfconfig(self, line):
+        """Show or change rdfmagic options"""
+        arg = parse_argstring(self.rdfconfig, line)
+        if arg.name is None:
+            names = sorted(_options.keys())
+        else:
+            names = [arg.name]
+        try:
+            if arg.value is not None:
+                set_option(arg.name, arg.value)
+            width = max(len(name) for name in names)
+            for name in names:
+                print ("{name:{width}} {value}".format(
+                    name=name, width=width, value=get_option(name)))
+        except (KeyError, ValueError) as e:
+            raise UsageError(str(e))
 
-        serializer = RDF.Serializer(name=arg.name)
-        with open(arg.filename, 'w') as outstream:
-            outstream.write(serializer.serialize_model_to_string())
-            outstream.write('\n')
 
+_from_re = re.compile(
+    "from <(?P<url>[A-Za-z0-9!@#$%^&*()-_\\|\'\"/?\]\[{}+=]+)>",
+    re.IGNORECASE)
 
 def extract_froms(cell, remove=True):
     """Extract from statements from sparql query
@@ -327,88 +1622,2232 @@ def extract_froms(cell, remove=True):
     if remove is true, remove the from statements from the query
     returns ([url, url], query)
     """
-    from_re = re.compile(
-        "from <(?P<url>[A-Za-z0-9!@#$%^&*()-_\\|\'\"/?\]\[{}+=]+)>",
-        re.IGNORECASE)
-    froms = []
-    match = from_re.search(cell)
-    while match is not None:
-        froms.append(match.group('url'))
-        if remove:
-            cell = from_re.sub('', cell, 1)
-        match = from_re.search(cell)
+    froms = [match.group('url') for match in _from_re.finditer(cell)]
+    if remove and froms:
+        cell = _from_re.sub('', cell)
     return froms, cell
 
+_prefix_header = None
+
+def prefix_header():
+    """Return the PREFIX lines for our namespaces
+
+    The header is rebuilt only after %addns or %delns change the prefixes.
+    """
+    global _prefix_header
+    if _prefix_header is None:
+        template = "PREFIX {prefix}: <{url}>"
+        _prefix_header = os.linesep.join(
+            template.format(prefix=prefix, url=namespace)
+            for prefix, namespace in _prefixes.items())
+    return _prefix_header
+
+def reset_prefix_header():
+    global _prefix_header
+    _prefix_header = None
+
 def prepare_query(cell):
     """Add additional our namespaces to head of query
     """
-    query = []
-    template = "PREFIX {prefix}: <{url}>"
-    for prefix, namespace in _prefixes.items():
-        query.append(template.format(prefix=prefix, url=namespace))
-    query.append(cell)
-    return os.linesep.join(query)
+    header = prefix_header()
+    if not header:
+        return cell
+    return header + os.linesep + cell
 
-def make_temp_model():
-    """Make a scratch model
+_template_token_re = re.compile(
+    r"""("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|<[^<>\s]*>|\#[^\n]*)|\$(\w+)""")
+_iri_forbidden_re = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+
+def sparql_iri(uri):
+    """Format uri as a SPARQL IRI, refusing characters that could escape it
     """
-    s = RDF.MemoryStorage()
-    m = RDF.Model(s)
-    return m
+    uri = str(uri)
+    if _iri_forbidden_re.search(uri):
+        raise ValueError("{0!r} is not a valid IRI".format(uri))
+    return '<' + uri + '>'
 
-def load_source(model, source):
-    if isinstance(source, RDF.Node):
-        source = str(source.uri)
+def sparql_literal(text, language=None, datatype=None):
+    """Format text as a quoted SPARQL literal
+    """
+    text = text.replace('\\', '\\\\').replace('"', '\\"')
+    text = text.replace('\n', '\\n').replace('\r', '\\r')
+    literal = '"' + text + '"'
+    if language:
+        if not re.match(r'^[A-Za-z]+(-[A-Za-z0-9]+)*$', language):
+            raise ValueError("{0!r} is not a language tag".format(language))
+        literal += '@' + language
+    elif datatype is not None:
+        literal += '^^' + sparql_iri(datatype)
+    return literal
 
-    url = urlparse(source)
-    if url.scheme is None:
-        source = 'file://'+os.path.abspath(source)
-        url = urlparse(source)
-    if url.scheme in ('http', 'https'):
-        # remote,
-        stream = urlopen(source)
-        content_type = stream.headers.get('content-type')
-        if stream.code == 200:
-            parser = guess_parser(content_type, url.path)
+def sparql_term(value):
+    """Format an RDF node or python value as a SPARQL term
+
+    URIs stay URIs, strings become plain literals and numbers and booleans
+    become XSD typed literals. Blank nodes can't be referred to from a
+    query so they are refused.
+    """
+    if hasattr(value, 'item') and not isinstance(value, RDF.Node):
+        # numpy scalars, such as values taken from a DataFrame
+        value = value.item()
+    if isinstance(value, RDF.Uri):
+        return sparql_iri(value)
+    if isinstance(value, RDF.Node):
+        if value.is_resource():
+            return sparql_iri(value.uri)
+        if value.is_blank():
+            raise ValueError("Blank nodes can't be bound in a query")
+        literal = value.literal_value
+        return sparql_literal(literal.get('string'), literal.get('language'),
+                              literal.get('datatype'))
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, six.integer_types):
+        return sparql_literal(str(value), datatype=XSD + 'integer')
+    if isinstance(value, float):
+        if value != value:
+            text = 'NaN'
+        elif value in (float('inf'), float('-inf')):
+            text = 'INF' if value > 0 else '-INF'
         else:
-            raise HTTPError("Problem opening {}: {}".format(
-                source, stream.code))
-        body = stream.read().decode(stream.headers.get_content_charset())
+            text = repr(value)
+        return sparql_literal(text, datatype=XSD + 'double')
+    if isinstance(value, six.binary_type):
+        value = value.decode('utf-8')
+    if isinstance(value, six.string_types):
+        return sparql_literal(value)
+    raise TypeError("Can't bind {0!r} in a query".format(value))
 
-    elif url.scheme in ('file'):
-        # local
-        if not os.path.exists(url.path):
-            raise IOError("File %s does not exist" % (url.path,))
-        stream = open(url.path, 'rt')
-        parser = guess_parser(None, url.path)
-        body = stream.read()
+class SparqlTemplate(object):
+    """A query with $name parameters that is prepared once and run many times
 
-    stream.close()
-    parser.parse_string_into_model(model, body, source)
+    FROM clauses are extracted and the prefix header added when the
+    template is made. Binding a parameter substitutes the value as an
+    RDF term (see sparql_term), never as raw query text, so a value
+    can't change the shape of the query. librdf can't bind values into
+    an already parsed query, so each execution still parses the bound
+    text.
 
+    Queries run against model, the FROM and sources loaded into a model
+    of the template's own, or a SPARQL Protocol endpoint.
+    """
+    def __init__(self, text, model=None, sources=None, endpoint=None):
+        froms, body = extract_froms(text)
+        self.sources = [normalize_source(s) for s in froms + list(sources or [])]
+        self.model = model
+        self.endpoint = endpoint
+        self.text = prepare_query(body)
+        self._parts = []
+        self.parameters = []
+        start = 0
+        for match in _template_token_re.finditer(self.text):
+            name = match.group(2)
+            if name is None:
+                continue
+            self._parts.append(self.text[start:match.start()])
+            self.parameters.append(name)
+            start = match.end()
+        self._parts.append(self.text[start:])
+        self._lock = threading.Lock()
 
-def guess_parser(content_type, pathname):
-    name = guess_parser_name(content_type, pathname)
-    return RDF.Parser(name=name)
+    def __repr__(self):
+        return '<SparqlTemplate ({0})>'.format(', '.join(self.parameters))
 
+    def bind(self, values=None, **kwargs):
+        """Return the query text with parameters replaced by values
+        """
+        if values is not None:
+            kwargs = dict(values, **kwargs)
+        query = [self._parts[0]]
+        for name, part in zip(self.parameters, self._parts[1:]):
+            if name not in kwargs:
+                raise KeyError("No value for template parameter {0}".format(name))
+            query.append(sparql_term(kwargs[name]))
+            query.append(part)
+        return ''.join(query)
 
-def guess_parser_name(content_type, pathname):
-    if content_type is None or content_type.startswith('text/plain'):
-        return guess_parser_name_by_extension(pathname)
-    if content_type.startswith('application/rdf+xml'):
-        return 'rdfxml'
-    elif content_type.startswith('application/x-turtle'):
-        return 'turtle'
-    elif content_type.startswith('text/turtle'):
-        return 'turtle'
-    elif content_type.startswith('text/html'):
+    def get_model(self):
+        """Return the model to query, loading the template's sources once
+        """
+        with self._lock:
+            if self.model is None:
+                self.model = make_temp_model()
+                errors = load_sources(self.model, self.sources)
+                for source, error in errors.items():
+                    logger.error("Unable to load %s: %s", source, error)
+            return self.model
+
+    def execute(self, values=None, lazy=None, **kwargs):
+        """Bind values and run the query, returning its results
+        """
+        query = self.bind(values, **kwargs)
+        if self.endpoint is not None:
+            return query_endpoint(self.endpoint, query)
+        if lazy is None:
+            lazy = get_option('results.lazy')
+        model = self.get_model()
+        with self._lock:
+            result_set = RDF.SPARQLQuery(query).execute(model)
+            return LibRdfResults(result_set, lazy=lazy, query=query,
+                                 model=model)
+
+    __call__ = execute
+
+    def execute_many(self, rows, jobs=None):
+        """Run the query once for each row of parameter values
+
+        rows may be a list of dictionaries or a pandas DataFrame whose
+        columns are named after the parameters. With an endpoint up to
+        jobs queries are sent at a time. Local queries all read the
+        template's one model, which is only used by one thread at a time,
+        so they run one after another.
+
+        returns a list of results in the order of rows
+        """
+        if hasattr(rows, 'to_dict'):
+            rows = rows.to_dict('records')
+        rows = list(rows)
+        if jobs is None:
+            jobs = get_option('load.jobs')
+        if self.endpoint is None or jobs <= 1 or len(rows) <= 1:
+            return [self.execute(row) for row in rows]
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(self.execute, rows))
+
+_select_re = re.compile(r'\bselect\b\s*(?:(distinct|reduced)\b)?',
+                        re.IGNORECASE)
+_order_by_re = re.compile(r'\border\s+by\b(.*?)(?=\blimit\b|\boffset\b|$)',
+                          re.IGNORECASE | re.DOTALL)
+_order_term_re = re.compile(r'(asc|desc)\s*\(\s*[?$](\w+)\s*\)|[?$](\w+)',
+                            re.IGNORECASE)
+_limit_offset_re = re.compile(r'\b(limit|offset)\s+(\d+)', re.IGNORECASE)
+
+_aggregate_re = re.compile(
+    r'\bgroup\s+by\b|\bhaving\b|'
+    r'\b(count|sum|min|max|avg|sample|group_concat)\s*\(', re.IGNORECASE)
+
+def _query_code(query):
+    """Blank out strings, IRIs and comments so keywords can be searched for
+    """
+    return _template_token_re.sub(
+        lambda match: ' ' if match.group(1) is not None else match.group(0),
+        query)
+
+def has_aggregates(query):
+    """Return True if a query uses GROUP BY, HAVING or aggregate functions
+    """
+    return _aggregate_re.search(_query_code(query)) is not None
+
+def is_distinct(query):
+    """Return True if the outermost SELECT is DISTINCT or REDUCED
+
+    A DISTINCT inside a subquery only applies to the subquery's rows.
+    """
+    code = _query_code(query)
+    match = _select_re.search(code)
+    if match is None or match.start() > code.find('{'):
+        return False
+    return match.group(1) is not None
+
+def split_solution_modifiers(query):
+    """Take LIMIT and OFFSET off a query and parse its ORDER BY
+
+    Only modifiers after the last closing brace belong to the outer query.
+
+    returns (query, [(variable, descending), ...], limit, offset) where the
+    query has LIMIT and OFFSET removed
+    """
+    cut = query.rfind('}') + 1
+    head, tail = query[:cut], query[cut:]
+    order = []
+    match = _order_by_re.search(tail)
+    if match is not None:
+        terms = match.group(1)
+        if _order_term_re.sub('', terms).strip():
+            raise ValueError("Only ORDER BY on variables can be merged")
+        for term in _order_term_re.finditer(terms):
+            if term.group(2) is not None:
+                order.append((term.group(2), term.group(1).lower() == 'desc'))
+            else:
+                order.append((term.group(3), False))
+    limit = None
+    offset = 0
+    for match in _limit_offset_re.finditer(tail):
+        if match.group(1).lower() == 'limit':
+            limit = int(match.group(2))
+        else:
+            offset = int(match.group(2))
+    return head + _limit_offset_re.sub('', tail), order, limit, offset
+
+def order_key(node):
+    """Return a sort key roughly following SPARQL ORDER BY
+
+    Unbound values sort first, then blank nodes, URIs and literals, with
+    numeric literals compared by value.
+    """
+    if node is None:
+        return (0,)
+    if node.is_blank():
+        return (1, node.blank_identifier)
+    if node.is_resource():
+        return (2, str(node.uri))
+    value = node.literal_value['string']
+    if node_kind(node) in ('integer', 'float'):
+        try:
+            return (3, 0, float(value), '')
+        except ValueError:
+            pass
+    return (3, 1, 0.0, value)
+
+class _Descending(object):
+    """Invert the ordering of a sort key"""
+    __slots__ = ('key',)
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+def federate_query(query, models, lazy=False):
+    """Run a select query against several models and merge the results
+
+    The query is run against each model in turn on the calling thread,
+    and the rows are merged as they are read so the union of the models
+    is never built. If the query has an
+    ORDER BY on variables the already sorted rows of each model are merge
+    sorted. LIMIT is pushed down to each model, as LIMIT plus OFFSET, and
+    applied again to the merged rows. DISTINCT and REDUCED queries have
+    duplicates across models removed.
+
+    Aggregates would be computed per model and give wrong answers, so
+    queries using them are refused.
+    """
+    if not models:
+        raise ValueError("No models to query")
+    if has_aggregates(query):
+        raise ValueError("Queries with GROUP BY, HAVING or aggregates "
+                         "can't be federated")
+    body, order, limit, offset = split_solution_modifiers(query)
+    if limit is not None:
+        body += os.linesep + 'LIMIT {0}'.format(limit + offset)
+    distinct = is_distinct(query)
+
+    queries = [RDF.SPARQLQuery(body) for model in models]
+    result_sets = [query.execute(model)
+                   for query, model in zip(queries, models)]
+    if not all(r.is_bindings() for r in result_sets):
+        raise ValueError("Only SELECT queries can be federated")
+    first = result_sets[0]
+    columns = [first.get_binding_name(i)
+               for i in range(first.get_bindings_count())]
+
+    def partition(query, result_set):
+        # hold on to the query for as long as its results are read
+        for row in result_set:
+            yield [row[k] for k in columns]
+    streams = [partition(q, r) for q, r in zip(queries, result_sets)]
+
+    if order:
+        try:
+            keys = [(columns.index(name), descending)
+                    for name, descending in order]
+        except ValueError:
+            raise ValueError("ORDER BY variables must be selected to be merged")
+        def keyed(number, stream):
+            for sequence, values in enumerate(stream):
+                key = tuple(_Descending(order_key(values[i])) if descending
+                            else order_key(values[i])
+                            for i, descending in keys)
+                yield key, number, sequence, values
+        merged = (item[3] for item in heapq.merge(
+            *[keyed(number, stream) for number, stream in enumerate(streams)]))
+    else:
+        merged = itertools.chain(*streams)
+
+    def rows():
+        seen = set()
+        skipped = 0
+        produced = 0
+        for values in merged:
+            if limit is not None and produced >= limit:
+                return
+            if distinct:
+                key = tuple(node_key(v) for v in values)
+                if key in seen:
+                    continue
+                seen.add(key)
+            if skipped < offset:
+                skipped += 1
+                continue
+            produced += 1
+            yield dict(zip(columns, values))
+
+    return LibRdfResults.from_rows(columns, rows(), lazy)
+
+def sparql_template(text, model=None, sources=None, endpoint=None):
+    """Prepare a query with $name parameters, see SparqlTemplate
+    """
+    return SparqlTemplate(text, model, sources, endpoint)
+
+_variable_token_re = re.compile(
+    r"""("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|<[^<>\s]*>|\#[^\n]*)|[?$](\w+)""")
+
+def query_variables(query):
+    """Return the set of variable names used in a query
+    """
+    return set(match.group(2) for match in _variable_token_re.finditer(query)
+               if match.group(2) is not None)
+
+def values_clause(columns, rows):
+    """Format rows of nodes as a SPARQL VALUES block, None becomes UNDEF
+    """
+    lines = ['VALUES ({0}) {{'.format(' '.join('?' + c for c in columns))]
+    for row in rows:
+        terms = ['UNDEF' if value is None else sparql_term(value)
+                 for value in row]
+        lines.append('  ({0})'.format(' '.join(terms)))
+    lines.append('}')
+    return os.linesep.join(lines)
+
+def concat_results(results_list, distinct=False):
+    """Join several results with the same variables into one LibRdfResults
+
+    With distinct, rows repeated in later results are left out.
+    """
+    combined = LibRdfResults(None)
+    seen = set()
+    for results in results_list:
+        if combined.columns is None:
+            combined.set_columns(results.columns)
+        order = [results.columns.index(c) for c in combined.columns]
+        for row in results.results:
+            values = [row[i] for i in order]
+            if distinct:
+                key = tuple(node_key(v) for v in values)
+                if key in seen:
+                    continue
+                seen.add(key)
+            combined.append_row(values)
+    if combined.columns is None:
+        combined.set_columns([])
+    return combined
+
+def run_bound_query(query, bindings, execute, batch_size=None):
+    """Run query for the rows of earlier results, a batch at a time
+
+    The columns of bindings that are also variables of query are sent
+    along as a VALUES block of up to batch_size distinct rows, so the
+    query runs once per batch instead of once per row. execute is called
+    with each query text and should return a LibRdfResults.
+
+    Since every batch is a separate query, ORDER BY, LIMIT, OFFSET and
+    aggregates would only apply within a batch, so queries using them are
+    refused. DISTINCT and REDUCED are applied again across batches.
+
+    returns the results of all the batches joined together
+    """
+    if batch_size is None:
+        batch_size = get_option('bind.batch_size')
+    if has_aggregates(query):
+        raise ValueError("Queries with GROUP BY, HAVING or aggregates "
+                         "can't be run in batches")
+    _, order, limit, offset = split_solution_modifiers(query)
+    if order or limit is not None or offset:
+        raise ValueError("Queries with ORDER BY, LIMIT or OFFSET "
+                         "can't be run in batches")
+    distinct = is_distinct(query)
+    variables = query_variables(query)
+    columns = [c for c in bindings.columns if c in variables]
+    if not columns:
+        raise ValueError("None of {0} are used in the query".format(
+            ', '.join(bindings.columns)))
+    indexes = [bindings.columns.index(c) for c in columns]
+
+    rows = collections.OrderedDict()
+    for row in bindings.results:
+        values = [row[i] for i in indexes]
+        rows.setdefault(tuple(node_key(v) for v in values), values)
+    rows = list(rows.values())
+
+    batches = []
+    # with no rows an empty VALUES block still reports the query's columns
+    for start in range(0, max(len(rows), 1), batch_size):
+        batch = rows[start:start + batch_size]
+        batches.append(execute(
+            query + os.linesep + values_clause(columns, batch)))
+    return concat_results(batches, distinct)
+
+def make_temp_model(contexts=False):
+    """Make a scratch model
+
+    With contexts the model can keep each source in its own context, so
+    changed sources can be refreshed.
+    """
+    if contexts:
+        s = RDF.MemoryStorage(options_string="contexts='yes'")
+    else:
+        s = RDF.MemoryStorage()
+    m = RDF.Model(s)
+    return m
+
+def supports_contexts(model):
+    """Return True if model's storage can keep statements in contexts
+    """
+    check = getattr(RDF.Redland, 'librdf_model_supports_contexts', None)
+    if check is None:
+        return False
+    return bool(check(model._model))
+
+def _model_transaction(model, action):
+    """Start, commit or rollback a transaction, returns True if it worked
+    """
+    func = getattr(RDF.Redland, 'librdf_model_transaction_' + action, None)
+    if func is None:
+        return False
+    return func(model._model) == 0
+
+def add_graph_results(model, query_results, batch_size=None):
+    """Add the statements of a CONSTRUCT or DESCRIBE result to model
+
+    If the storage supports transactions the statements are committed
+    batch_size at a time, otherwise the whole stream is handed to librdf
+    in one call.
+
+    returns how many statements the model grew by
+    """
+    if not query_results.is_graph():
+        raise ValueError("Only CONSTRUCT and DESCRIBE queries return graphs")
+    if batch_size is None:
+        batch_size = get_option('into.batch_size')
+    before = model.size()
+    stream = query_results.as_stream()
+    if not _model_transaction(model, 'start'):
+        model.add_statements(stream)
+        return model.size() - before
+
+    try:
+        count = 0
+        for statement in stream:
+            model.add_statement(statement)
+            count += 1
+            if count % batch_size == 0:
+                _model_transaction(model, 'commit')
+                _model_transaction(model, 'start')
+        _model_transaction(model, 'commit')
+    except BaseException:
+        _model_transaction(model, 'rollback')
+        raise
+    return model.size() - before
+
+def source_context(source):
+    """Return the context node the triples of source are kept in
+    """
+    return RDF.Node(uri_string=normalize_source(source))
+
+def normalize_source(source):
+    """Return source as an absolute url string
+    """
+    if isinstance(source, RDF.Node):
+        source = str(source.uri)
+
+    url = urlparse(source)
+    if not url.scheme:
+        source = 'file://'+os.path.abspath(source)
+    return source
+
+def file_validator(pathname):
+    """Return a string that changes whenever the file is modified
+    """
+    info = os.stat(pathname)
+    return "{0}:{1}".format(info.st_size, info.st_mtime)
+
+def http_validator(headers):
+    """Return a validator built from an HTTP ETag or Last-Modified header
+    """
+    etag = headers.get('etag')
+    if etag:
+        return 'etag:' + etag
+    modified = headers.get('last-modified')
+    if modified:
+        return 'modified:' + modified
+    return None
+
+def source_version(source, remote=False):
+    """Return a version string for a source if it can be determined cheaply
+
+    Only local files can be checked without a round trip, so unless
+    remote is set remote sources have no version and are assumed unchanged.
+    With remote set a HEAD request asks for their ETag or Last-Modified.
+    """
+    url = urlparse(normalize_source(source))
+    if url.scheme == 'file' and os.path.exists(url.path):
+        return file_validator(url.path)
+    if remote and url.scheme in ('http', 'https'):
+        request = Request(normalize_source(source))
+        request.get_method = lambda: 'HEAD'
+        try:
+            response = urlopen(request)
+        except (IOError, HTTPError):
+            return None
+        try:
+            return http_validator(response.headers)
+        finally:
+            response.close()
+    return None
+
+def source_digest(source, chunk_size=1024 * 1024):
+    """Return a hash of a local source's contents, or None for remote ones
+
+    Used to notice files that were touched without being changed.
+    """
+    url = urlparse(normalize_source(source))
+    if url.scheme != 'file' or not os.path.exists(url.path):
+        return None
+    digest = hashlib.sha1()
+    with open(url.path, 'rb') as instream:
+        for block in iter(lambda: instream.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_source(model, source, cache=None, stats=None):
+    """Load triples from source into model
+
+    If a source cache is provided (or enabled in the options) parsed sources
+    are reused as long as their validator has not changed. If a QueryStats
+    is provided the time, bytes and triples for the source are added to it.
+
+    returns the validator of the copy that was loaded, or None
+    """
+    source = normalize_source(source)
+    if cache is None:
+        cache = get_source_cache()
+    if stats is None:
+        return _load_source(model, source, cache, _null_stats)
+
+    before = model.size()
+    start = time.time()
+    validator = _load_source(model, source, cache, stats)
+    stats.update_source(source, seconds=time.time() - start,
+                        triples=model.size() - before)
+    return validator
+
+def _load_source(model, source, cache, stats):
+    url = urlparse(source)
+
+    if url.scheme in ('http', 'https'):
+        # remote,
+        entry = cache.lookup(source) if cache is not None else None
+        request = Request(source)
+        if entry is not None:
+            validator = entry['validator']
+            if validator.startswith('etag:'):
+                request.add_header('If-None-Match', validator[len('etag:'):])
+            elif validator.startswith('modified:'):
+                request.add_header('If-Modified-Since',
+                                   validator[len('modified:'):])
+        try:
+            stream = urlopen(request)
+        except HTTPError as e:
+            if e.code == 304 and entry is not None:
+                with stats.phase('cache', source):
+                    cache.load_into_model(model, source, entry['validator'])
+                return entry['validator']
+            raise
+        if stream.code != 200:
+            raise IOError("Problem opening {}: {}".format(
+                source, stream.code))
+        validator = http_validator(stream.headers)
+        if cache is not None and validator is not None:
+            with stats.phase('cache', source):
+                cached = cache.load_into_model(model, source, validator)
+            if cached:
+                stream.close()
+                return validator
+        content_type = stream.headers.get('content-type')
+        parser = guess_parser(content_type, url.path)
+        _, compression = split_compression(url.path)
+        encoding = stream.headers.get('content-encoding', '').lower()
+        if encoding in ('gzip', 'x-gzip'):
+            compression = 'gzip'
+        body = stream
+        if compression is not None:
+            body = decompress_stream(stream, compression)
+        with stats.phase('fetch', source):
+            spool = spool_stream(body)
+        stream.close()
+        try:
+            stats.update_source(source, bytes=os.path.getsize(spool))
+            parse_source(parser, model, 'file://' + spool, source,
+                         cache, validator, stats)
+        finally:
+            os.unlink(spool)
+        return validator
+
+    elif url.scheme in ('file'):
+        # local
+        if not os.path.exists(url.path):
+            raise IOError("File %s does not exist" % (url.path,))
+        _, compression = split_compression(url.path)
+        parser_name = guess_parser_name(None, url.path)
+        parser = RDF.Parser(name=parser_name)
+        # N-Triples is already the cache format, nothing to gain by copying
+        # and the cache would lose the graphs of N-Quads.
+        if parser_name in LINE_FORMATS:
+            cache = None
+        validator = file_validator(url.path)
+        if cache is not None:
+            with stats.phase('cache', source):
+                cached = cache.load_into_model(model, source, validator)
+            if cached:
+                return validator
+        stats.update_source(source, bytes=os.path.getsize(url.path))
+        if compression is None:
+            parse_source(parser, model, source, source, cache, validator,
+                         stats)
+        elif parser_name in LINE_FORMATS:
+            with open_compressed(url.path, compression) as stream:
+                with stats.phase('parse', source):
+                    load_lines(model, stream, source, parser_name)
+        else:
+            with open_compressed(url.path, compression) as stream:
+                with stats.phase('fetch', source):
+                    spool = spool_stream(stream)
+            try:
+                parse_source(parser, model, 'file://' + spool, source,
+                             cache, validator, stats)
+            finally:
+                os.unlink(spool)
+        return validator
+    else:
+        raise ValueError("Unsupported source scheme {0}".format(url.scheme))
+
+
+LINE_FORMATS = ('ntriples', 'nquads')
+
+def iter_line_chunks(stream, chunk_size):
+    """Yield blocks of about chunk_size bytes that end on a line boundary
+    """
+    remainder = b''
+    while True:
+        block = stream.read(chunk_size)
+        if not block:
+            break
+        block = remainder + block
+        end = block.rfind(b'\n')
+        if end < 0:
+            remainder = block
+            continue
+        remainder = block[end + 1:]
+        yield block[:end + 1]
+    if remainder:
+        yield remainder
+
+def prefetch(iterable, depth):
+    """Run iterable on a worker thread, keeping up to depth items ready
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+
+    worker = threading.Thread(target=produce)
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+def load_lines(model, stream, base_uri, parser_name='ntriples',
+               chunk_size=None, jobs=None):
+    """Parse a line oriented source, such as N-Triples, a chunk at a time
+
+    Since every line stands alone the stream can be split on line
+    boundaries and each chunk parsed separately, so neither the whole
+    file nor its decompressed text is ever held in memory. With more than
+    one job, reading and decompressing the next chunks overlaps with
+    parsing. librdf models can't be shared between processes, so the
+    parsing itself stays in this one.
+
+    librdf gives blank nodes new ids in every parse, so once a chunk might
+    use one the rest of the stream is spooled to a temporary file and
+    parsed in one go, keeping every label that appears again later on the
+    same node.
+    """
+    if chunk_size is None:
+        chunk_size = get_option('load.chunk_size')
+    if jobs is None:
+        jobs = get_option('load.jobs')
+    parser = RDF.Parser(name=parser_name)
+    chunks = iter_line_chunks(stream, chunk_size)
+    if jobs > 1:
+        chunks = prefetch(chunks, jobs)
+    for chunk in chunks:
+        if b'_:' in chunk:
+            break
+        parser.parse_string_into_model(model, chunk.decode('utf-8'), base_uri)
+    else:
+        return
+    with tempfile.NamedTemporaryFile(prefix='rdfmagic_', delete=False) as spool:
+        spool.write(chunk)
+        for chunk in chunks:
+            spool.write(chunk)
+    try:
+        parser.parse_into_model(model, 'file://' + spool.name, base_uri)
+    finally:
+        os.unlink(spool.name)
+
+def spool_stream(stream, chunk_size=1024 * 1024):
+    """Copy a file like object to a temporary file in fixed size chunks
+
+    returns the name of the temporary file, which the caller should remove.
+    """
+    with tempfile.NamedTemporaryFile(prefix='rdfmagic_', delete=False) as spool:
+        shutil.copyfileobj(stream, spool, chunk_size)
+        return spool.name
+
+
+def parse_source(parser, model, uri, base_uri, cache=None, validator=None,
+                 stats=None):
+    """Let librdf read and parse uri directly into model
+
+    If a cache is given the parsed triples are also stored in it. When
+    model is empty, as the staging models of load_sources are, it is
+    serialized to the cache directly, otherwise the source is parsed into
+    a separate model first so only its triples are cached.
+    """
+    if stats is None:
+        stats = _null_stats
+    if cache is None or validator is None:
+        with stats.phase('parse', base_uri):
+            parser.parse_into_model(model, uri, base_uri)
+    elif model.size() == 0:
+        with stats.phase('parse', base_uri):
+            parser.parse_into_model(model, uri, base_uri)
+        with stats.phase('cache', base_uri):
+            cache.store(base_uri, validator, model)
+    else:
+        staging = make_temp_model()
+        with stats.phase('parse', base_uri):
+            parser.parse_into_model(staging, uri, base_uri)
+        with stats.phase('cache', base_uri):
+            cache.store(base_uri, validator, staging)
+        model.add_statements(staging.as_stream())
+
+
+def load_sources(model, sources, jobs=None, callback=None, stats=None,
+                 contexts=False, summaries=None, validators=None):
+    """Load several sources into model, jobs of them at a time
+
+    With more than one job each source is fetched and parsed into its own
+    staging model on a worker thread and then merged into model.
+    callback is called with each source after it has been tried.
+
+    With contexts each source is stored in the context named by its url,
+    replacing whatever was in that context once the new copy has parsed.
+
+    If summaries is a dictionary a DatasetStats of each loaded source is
+    stored in it. Likewise if validators is a dictionary the validator of
+    each loaded copy is stored in it.
+
+    returns a dictionary mapping sources that failed to their exception
+    """
+    if jobs is None:
+        jobs = get_option('load.jobs')
+    errors = collections.OrderedDict()
+
+    lock = threading.Lock()
+    def load_staged(source):
+        staging = make_temp_model()
+        validator = load_source(staging, source, stats=stats)
+        if validators is not None:
+            validators[source] = validator
+        if summaries is not None:
+            summary = DatasetStats()
+            summary.add_model(staging)
+            summaries[source] = summary
+        with lock:
+            if contexts:
+                context = source_context(source)
+                model.remove_statements_with_context(context)
+                model.add_statements(staging.as_stream(), context)
+            else:
+                model.add_statements(staging.as_stream())
+
+    if jobs <= 1 or len(sources) <= 1:
+        for source in sources:
+            try:
+                if contexts or summaries is not None:
+                    load_staged(source)
+                else:
+                    validator = load_source(model, source, stats=stats)
+                    if validators is not None:
+                        validators[source] = validator
+            except Exception as e:
+                errors[source] = e
+            if callback is not None:
+                callback(source)
+        return errors
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [(source, pool.submit(load_staged, source))
+                   for source in sources]
+        try:
+            for source, future in futures:
+                error = future.exception()
+                if error is not None:
+                    errors[source] = error
+                if callback is not None:
+                    callback(source)
+        except BaseException:
+            for source, future in futures:
+                future.cancel()
+            raise
+    return errors
+
+
+class SourceCache(object):
+    """On-disk cache of parsed sources
+
+    Each parsed source is stored as an N-Triples file named by the hash of
+    its url and validator, which is much faster to reload than the original
+    turtle or rdf/xml. The least recently used entries are removed when the
+    cache grows past max_size bytes, unless they have been pinned.
+    """
+    index_name = 'index.json'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._dirty = False
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.entries = self._read_index()
+        atexit.register(self.flush)
+
+    def _read_index(self):
+        index = os.path.join(self.directory, self.index_name)
+        if os.path.exists(index):
+            with open(index, 'rt') as instream:
+                try:
+                    return json.load(instream)
+                except ValueError:
+                    pass
+        return {}
+
+    def flush(self):
+        """Write access times that changed since the index was last saved
+        """
+        with self._lock:
+            if self._dirty:
+                self._write_index()
+
+    def _write_index(self):
+        self._dirty = False
+        index = os.path.join(self.directory, self.index_name)
+        temp = index + '.tmp'
+        with open(temp, 'wt') as outstream:
+            json.dump(self.entries, outstream, indent=1)
+        os.rename(temp, index)
+
+    def make_key(self, source, validator):
+        key = hashlib.sha1()
+        key.update(source.encode('utf-8'))
+        key.update(b'\0')
+        key.update(validator.encode('utf-8'))
+        return key.hexdigest()
+
+    def get_pathname(self, entry):
+        return os.path.join(self.directory, entry['key'] + '.nt')
+
+    def lookup(self, source):
+        """Return cache entry for source if there is one
+        """
+        with self._lock:
+            entry = self.entries.get(source)
+            if entry is not None and \
+               not os.path.exists(self.get_pathname(entry)):
+                del self.entries[source]
+                entry = None
+            return entry
+
+    def load_into_model(self, model, source, validator):
+        """Load source from cache if its validator still matches
+
+        returns True if the cache was used.
+        """
+        with self._lock:
+            entry = self.lookup(source)
+            if entry is None or entry['validator'] != validator:
+                self.misses += 1
+                return False
+            self.hits += 1
+            # the index is written with the next change, or at exit
+            entry['atime'] = time.time()
+            self._dirty = True
+            pathname = self.get_pathname(entry)
+
+        parser = RDF.Parser(name='ntriples')
+        parser.parse_into_model(model, 'file://' + pathname, source)
+        return True
+
+    def store(self, source, validator, model):
+        """Serialize model as the cached copy of source
+        """
+        with self._lock:
+            old = self.entries.get(source)
+            entry = {
+                'key': self.make_key(source, validator),
+                'validator': validator,
+                'atime': time.time(),
+                'pinned': old['pinned'] if old is not None else False,
+            }
+            pathname = self.get_pathname(entry)
+            temp = pathname + '.tmp'
+            serializer = RDF.Serializer(name='ntriples')
+            serializer.serialize_model_to_file(temp, model)
+            os.rename(temp, pathname)
+            entry['size'] = os.path.getsize(pathname)
+            if old is not None and old['key'] != entry['key']:
+                self._remove_file(old)
+            self.entries[source] = entry
+            self.evict()
+            self._write_index()
+
+    def _remove_file(self, entry):
+        pathname = self.get_pathname(entry)
+        if os.path.exists(pathname):
+            os.unlink(pathname)
+
+    def size(self):
+        return sum(e['size'] for e in self.entries.values())
+
+    def evict(self):
+        """Remove least recently used unpinned entries until under max_size
+        """
+        with self._lock:
+            total = self.size()
+            by_age = sorted(self.entries.items(), key=lambda x: x[1]['atime'])
+            for source, entry in by_age:
+                if total <= self.max_size:
+                    break
+                if entry['pinned']:
+                    continue
+                self._remove_file(entry)
+                del self.entries[source]
+                total -= entry['size']
+
+    def purge(self, sources=None, include_pinned=False):
+        """Remove sources (or everything) from the cache
+        """
+        with self._lock:
+            if not sources:
+                sources = list(self.entries.keys())
+            for source in sources:
+                source = normalize_source(source)
+                entry = self.entries.get(source)
+                if entry is None:
+                    continue
+                if entry['pinned'] and not include_pinned:
+                    continue
+                self._remove_file(entry)
+                del self.entries[source]
+            self._write_index()
+
+    def pin(self, source, pinned=True):
+        """Protect a source from eviction
+        """
+        with self._lock:
+            source = normalize_source(source)
+            if source not in self.entries:
+                raise KeyError("{0} is not cached".format(source))
+            self.entries[source]['pinned'] = pinned
+            self._write_index()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'entries': len(self.entries),
+                'pinned': sum(1 for e in self.entries.values() if e['pinned']),
+                'size': self.size(),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def stats_file_for(sources_file):
+    """Return where load statistics are kept for a model's sources file
+    """
+    if sources_file.endswith('-sources.json'):
+        sources_file = sources_file[:-len('-sources.json')]
+    return sources_file + '-stats.json'
+
+class HyperLogLog(object):
+    """Estimate how many distinct values were added in fixed memory
+
+    Uses 2 ** precision one byte registers, giving a standard error of
+    about 1.04 / sqrt(2 ** precision), 1.6% for the default. Sketches of
+    different sets can be merged to estimate their union.
+    """
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        if registers is None:
+            registers = bytearray(1 << precision)
+        self.registers = bytearray(registers)
+
+    def add(self, value):
+        if isinstance(value, six.text_type):
+            value = value.encode('utf-8')
+        code = struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+        width = 64 - self.precision
+        index = code >> width
+        rank = width - (code & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """Merge another sketch with the same precision into this one
+        """
+        if other.precision != self.precision:
+            raise ValueError("Can't merge sketches of different precision")
+        self.registers = bytearray(
+            max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(b'\0')
+        if estimate <= 2.5 * size and zeros:
+            # few values, linear counting is more accurate
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+    def as_dict(self):
+        return {
+            'precision': self.precision,
+            'registers': base64.b64encode(bytes(self.registers)).decode('ascii'),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['precision'], base64.b64decode(data['registers']))
+
+
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+VOID = 'http://rdfs.org/ns/void#'
+
+def split_namespace(uri):
+    """Return the part of uri up to its last # or /
+    """
+    end = max(uri.rfind('#'), uri.rfind('/'))
+    return uri[:end + 1]
+
+class DatasetStats(object):
+    """Triple, predicate and class counts for a set of statements
+
+    Distinct subjects and objects are estimated with HyperLogLog sketches
+    so summaries of several sources can be combined without keeping the
+    values themselves.
+    """
+    def __init__(self):
+        self.triples = 0
+        self.predicates = collections.Counter()
+        self.classes = collections.Counter()
+        self.subjects = HyperLogLog()
+        self.objects = HyperLogLog()
+
+    def add_statement(self, statement):
+        self.triples += 1
+        predicate = str(statement.predicate.uri)
+        self.predicates[predicate] += 1
+        self.subjects.add(str(statement.subject))
+        obj = statement.object
+        self.objects.add(str(obj))
+        if predicate == RDF_TYPE and obj.is_resource():
+            self.classes[str(obj.uri)] += 1
+
+    def add_model(self, model):
+        for statement in model:
+            self.add_statement(statement)
+
+    def update(self, other):
+        self.triples += other.triples
+        self.predicates.update(other.predicates)
+        self.classes.update(other.classes)
+        self.subjects.update(other.subjects)
+        self.objects.update(other.objects)
+
+    @classmethod
+    def merged(cls, summaries):
+        total = cls()
+        for summary in summaries:
+            total.update(summary)
+        return total
+
+    def namespaces(self):
+        """Count how often each namespace is used by predicates and classes
+        """
+        counts = collections.Counter()
+        for counter in (self.predicates, self.classes):
+            for uri, count in counter.items():
+                counts[split_namespace(uri)] += count
+        return counts
+
+    def format(self, top=10):
+        output = [
+            "triples            {0}".format(self.triples),
+            "distinct subjects ~{0}".format(self.subjects.count()),
+            "distinct objects  ~{0}".format(self.objects.count()),
+            "predicates:",
+        ]
+        for uri, count in self.predicates.most_common(top):
+            output.append("  {0} {1}".format(count, _namespace_index.shorten(uri)))
+        output.append("classes:")
+        for uri, count in self.classes.most_common(top):
+            output.append("  {0} {1}".format(count, _namespace_index.shorten(uri)))
+        return os.linesep.join(output)
+
+    def as_dict(self):
+        return {
+            'triples': self.triples,
+            'predicates': dict(self.predicates),
+            'classes': dict(self.classes),
+            'subjects': self.subjects.as_dict(),
+            'objects': self.objects.as_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls()
+        summary.triples = data['triples']
+        summary.predicates.update(data['predicates'])
+        summary.classes.update(data['classes'])
+        summary.subjects = HyperLogLog.from_dict(data['subjects'])
+        summary.objects = HyperLogLog.from_dict(data['objects'])
+        return summary
+
+    def to_void(self, dataset_uri, sources=()):
+        """Return a model describing the statistics with the VoID vocabulary
+        """
+        model = make_temp_model()
+        dataset = RDF.Node(uri_string=dataset_uri)
+
+        def add(subject, predicate, obj):
+            model.add_statement(RDF.Statement(
+                subject, RDF.Node(uri_string=predicate), obj))
+
+        def integer(value):
+            return RDF.Node(literal=str(value),
+                            datatype=RDF.Uri(XSD + 'integer'))
+
+        add(dataset, RDF_TYPE, RDF.Node(uri_string=VOID + 'Dataset'))
+        add(dataset, VOID + 'triples', integer(self.triples))
+        add(dataset, VOID + 'distinctSubjects', integer(self.subjects.count()))
+        add(dataset, VOID + 'distinctObjects', integer(self.objects.count()))
+        add(dataset, VOID + 'properties', integer(len(self.predicates)))
+        add(dataset, VOID + 'classes', integer(len(self.classes)))
+        for source in sources:
+            add(dataset, VOID + 'dataDump', RDF.Node(uri_string=source))
+        for i, (uri, count) in enumerate(sorted(self.predicates.items())):
+            partition = RDF.Node(blank='property{0}'.format(i))
+            add(dataset, VOID + 'propertyPartition', partition)
+            add(partition, VOID + 'property', RDF.Node(uri_string=uri))
+            add(partition, VOID + 'triples', integer(count))
+        for i, (uri, count) in enumerate(sorted(self.classes.items())):
+            partition = RDF.Node(blank='class{0}'.format(i))
+            add(dataset, VOID + 'classPartition', partition)
+            add(partition, VOID + 'class', RDF.Node(uri_string=uri))
+            add(partition, VOID + 'entities', integer(count))
+        return model
+
+
+class ModelEntry(object):
+    """Sources that have been loaded into a model
+
+    For models kept on disk the source list is saved next to the store so
+    it survives restarts. The model is only weakly referenced, so models
+    the user deletes or rebinds can still be freed.
+    """
+    def __init__(self, model, name, sources_file=None):
+        self._model = weakref.ref(model)
+        self.name = name
+        self.sources = collections.OrderedDict()
+        self.digests = {}
+        self.checked = {}
+        self.generation = 0
+        self.lock = threading.RLock()
+        self.sources_file = sources_file
+        self.stats = collections.OrderedDict()
+        self.stats_file = None
+        if sources_file is not None:
+            self.stats_file = stats_file_for(sources_file)
+            if os.path.exists(self.stats_file):
+                with open(self.stats_file, 'rt') as instream:
+                    for source, summary in json.load(instream):
+                        self.stats[source] = DatasetStats.from_dict(summary)
+        if sources_file is not None and os.path.exists(sources_file):
+            with open(sources_file, 'rt') as instream:
+                self.sources.update(json.load(instream))
+
+    @property
+    def model(self):
+        """The model, or None once nothing else refers to it"""
+        return self._model()
+
+    def save_sources(self):
+        if self.sources_file is None:
+            return
+        temp = self.sources_file + '.tmp'
+        with open(temp, 'wt') as outstream:
+            json.dump(list(self.sources.items()), outstream, indent=1)
+        os.rename(temp, self.sources_file)
+
+    def save_stats(self):
+        if self.stats_file is None:
+            return
+        temp = self.stats_file + '.tmp'
+        with open(temp, 'wt') as outstream:
+            json.dump([(source, summary.as_dict())
+                       for source, summary in self.stats.items()], outstream)
+        os.rename(temp, self.stats_file)
+
+
+class ModelRegistry(object):
+    """Track which sources, and which versions, were loaded into models
+
+    Temporary models made for %%sparql -s are kept around so that querying
+    the same sources again reuses the already parsed model. Other models
+    are forgotten once they have been freed.
+    """
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self._temp = collections.OrderedDict()
+        self._temp_count = 0
+        # background queries share the registry with the kernel thread
+        self._lock = threading.RLock()
+
+    def _prune(self):
+        for key, entry in list(self._entries.items()):
+            if entry.model is None:
+                del self._entries[key]
+
+    def entries(self):
+        with self._lock:
+            self._prune()
+            return list(self._entries.values())
+
+    def entry(self, model):
+        """Return the entry for a registered model, or None
+        """
+        with self._lock:
+            entry = self._entries.get(id(model))
+            if entry is None or entry.model is not model:
+                return None
+            return entry
+
+    def register(self, model, name=None, sources_file=None):
+        """Return the entry for model, adding it if needed
+        """
+        with self._lock:
+            self._prune()
+            entry = self._entries.get(id(model))
+            if entry is None or entry.model is not model:
+                if name is None:
+                    self._temp_count += 1
+                    name = 'temp{0}'.format(self._temp_count)
+                entry = ModelEntry(model, name, sources_file)
+                self._entries[id(model)] = entry
+            elif name is not None:
+                entry.name = name
+            return entry
+
+    def get_temp_model(self, sources):
+        """Return a temporary model holding exactly these sources
+
+        If a previous query used the same sources at the same versions
+        its model is reused, otherwise a new one is made.
+        """
+        with self._lock:
+            key = frozenset(
+                (s, source_version(s)) for s in map(normalize_source, sources))
+            model = self._temp.pop(key, None)
+            if model is None:
+                model = make_temp_model()
+                self.register(model)
+            # most recently used goes last
+            self._temp[key] = model
+            while len(self._temp) > get_option('models.max_temp'):
+                _, old = self._temp.popitem(last=False)
+                self._entries.pop(id(old), None)
+            return model
+
+    def generation(self, model):
+        """Return how many loads a registered model has seen, or None
+        """
+        with self._lock:
+            entry = self._entries.get(id(model))
+            if entry is None or entry.model is not model:
+                return None
+            return entry.generation
+
+    def sources(self, model):
+        """Return the sources loaded into a registered model
+        """
+        with self._lock:
+            entry = self._entries.get(id(model))
+            if entry is None or entry.model is not model:
+                return []
+            return list(entry.sources.keys())
+
+    def is_loaded(self, model, source, version):
+        """Return True if this version of source is already in model
+
+        A version of None means it couldn't be checked, which counts as
+        unchanged. Files whose timestamp changed are hashed and compared
+        to the digest from the last time that happened, so only files that
+        are touched more than once are read an extra time.
+        """
+        with self._lock:
+            entry = self._entries.get(id(model))
+            if entry is None or entry.model is not model:
+                return False
+            if source not in entry.sources:
+                return False
+            if version is None or entry.sources[source] == version:
+                return True
+            digest = source_digest(source)
+            if digest is None:
+                return False
+            if entry.digests.get(source) == digest:
+                entry.sources[source] = version
+                entry.save_sources()
+                return True
+            # kept until the reload is recorded, a failed one must not count
+            entry.checked[source] = (version, digest)
+            return False
+
+    def load_lock(self, model):
+        """Return the lock held while loading sources into or querying model
+
+        librdf models are only used by one thread at a time. Different
+        models, such as the staging models of load_sources, can be used
+        from different threads.
+        """
+        with self._lock:
+            entry = self._entries.get(id(model))
+            if entry is None or entry.model is not model:
+                return threading.RLock()
+            return entry.lock
+
+    def touch(self, model):
+        """Note that a registered model changed outside of loading sources
+        """
+        with self._lock:
+            entry = self._entries.get(id(model))
+            if entry is not None and entry.model is model:
+                entry.generation += 1
+
+    def record(self, model, source, version, summary=None):
+        """Note that source was loaded into a registered model
+
+        summary, a DatasetStats for the source, replaces the statistics
+        of any earlier copy of it.
+        """
+        with self._lock:
+            entry = self._entries.get(id(model))
+            if entry is None or entry.model is not model:
+                return
+            entry.sources[source] = version
+            checked = entry.checked.pop(source, None)
+            if checked is not None and checked[0] == version:
+                entry.digests[source] = checked[1]
+            entry.generation += 1
+            entry.save_sources()
+            if summary is not None:
+                entry.stats[source] = summary
+                entry.save_stats()
+
+    def find(self, name):
+        """Return the entry for the model with this name, or None
+        """
+        with self._lock:
+            self._prune()
+            for entry in self._entries.values():
+                if entry.name == name:
+                    return entry
+            return None
+
+    def drop(self, names=None):
+        """Forget the named models, or every temporary model
+        """
+        with self._lock:
+            self._prune()
+            temp_models = set(id(m) for m in self._temp.values())
+            for key, entry in list(self._entries.items()):
+                if names:
+                    if entry.name not in names:
+                        continue
+                elif key not in temp_models:
+                    continue
+                del self._entries[key]
+            live = set(self._entries.keys())
+            for key, model in list(self._temp.items()):
+                if id(model) not in live:
+                    del self._temp[key]
+
+
+_query_token_re = re.compile(
+    r"""("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|<[^<>\s]*>)|(?:\s|\#[^\n]*)+""")
+
+def normalize_query(query):
+    """Remove comments and collapse whitespace outside of strings and IRIs
+    """
+    def replace(match):
+        if match.group(1) is not None:
+            return match.group(1)
+        return ' '
+    return _query_token_re.sub(replace, query).strip()
+
+
+class QueryCache(object):
+    """Remember recent query results
+
+    Results are keyed by the normalized query text, the sources requested,
+    and the model along with its load generation and size, so changing a
+    model makes its old results unreachable. The least recently
+    used results are dropped past query_cache.max_entries.
+    """
+    def __init__(self):
+        self._results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # background queries share the cache with the kernel thread
+        self._lock = threading.RLock()
+
+    def make_key(self, query, sources, model, entry):
+        """Return the cache key for a query, or None if it can't be cached
+
+        entry is the model's ModelEntry, which unlike id(model) can't be
+        reused by another model once this one is freed. Its generation
+        only changes when rdfmagic loads into the model, so the model's
+        size is included too, to notice statements added or removed
+        through the RDF API. Storages that can't report their size aren't
+        cached.
+        """
+        size = model.size()
+        if size < 0:
+            return None
+        return (normalize_query(query),
+                frozenset(normalize_source(s) for s in sources),
+                entry, entry.generation, size)
+
+    def get(self, key):
+        """Return the cached results for key, or None
+
+        Lazy results whose rows were streamed away by write() can't be
+        reused and are dropped.
+        """
+        with self._lock:
+            if key is None:
+                return None
+            results = self._results.pop(key, None)
+            if results is not None and getattr(results, 'consumed', False):
+                results = None
+            if results is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._results[key] = results
+            return results
+
+    def put(self, key, results):
+        with self._lock:
+            if key is None:
+                return
+            self._results[key] = results
+            while len(self._results) > get_option('query_cache.max_entries'):
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._results),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections, shared by host
+
+    Connections are handed out by acquire and returned with release once
+    their response has been read completely, so the next request to the
+    same host can reuse the open socket.
+    """
+    def __init__(self, timeout=None, max_idle=4):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.created = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+            self.created += 1
+        if scheme == 'https':
+            return http_client.HTTPSConnection(netloc, timeout=self.timeout), False
+        return http_client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def release(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """Send a request, retrying once if a reused connection went stale
+
+        returns (connection, response)
+        """
+        url = urlparse(url)
+        target = url.path or '/'
+        if url.query:
+            target += '?' + url.query
+        while True:
+            connection, reused = self.acquire(url.scheme, url.netloc)
+            try:
+                connection.request(method, target, body, headers or {})
+                return connection, connection.getresponse()
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+
+    def finish(self, url, connection, response):
+        """Return connection to the pool after its response is consumed
+        """
+        url = urlparse(url)
+        response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(url.scheme, url.netloc, connection)
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle = {}
+
+
+_connection_pool = ConnectionPool()
+
+# XML and TSV are parsed as they arrive, JSON has to be read whole
+RESULTS_ACCEPT = ', '.join([
+    'application/sparql-results+xml',
+    'text/tab-separated-values;q=0.9',
+    'application/sparql-results+json;q=0.8',
+])
+
+GRAPH_ACCEPT = ', '.join([
+    'application/n-triples',
+    'text/turtle;q=0.9',
+    'application/rdf+xml;q=0.8',
+])
+
+def post_query(endpoint, query, accept, handler, pool=None):
+    """Send a query to a SPARQL 1.1 Protocol service
+
+    handler is called with the decoded response body and its content type
+    and its return value is passed back.
+    """
+    if pool is None:
+        pool = _connection_pool
+    body = urlencode({'query': query})
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Accept': accept,
+        'Accept-Encoding': 'gzip',
+    }
+    connection, response = pool.request('POST', endpoint, body, headers)
+    try:
+        if response.status != 200:
+            raise IOError("Problem querying {0}: {1} {2}".format(
+                endpoint, response.status, response.read()[:200]))
+        stream = response
+        if response.getheader('content-encoding', '').lower() == 'gzip':
+            stream = gzip.GzipFile(fileobj=response, mode='rb')
+        content_type = response.getheader('content-type', '')
+        results = handler(stream, content_type)
+    except Exception:
+        connection.close()
+        raise
+    pool.finish(endpoint, connection, response)
+    return results
+
+def query_endpoint(endpoint, query, pool=None):
+    """Send a query to a SPARQL 1.1 Protocol service
+
+    returns LibRdfResults for select queries or a bool for ask queries.
+    """
+    return post_query(endpoint, query, RESULTS_ACCEPT, parse_sparql_results,
+                      pool)
+
+def query_endpoint_graph(endpoint, query, model, pool=None):
+    """Send a CONSTRUCT or DESCRIBE query to a service, parsing into model
+
+    N-Triples responses are parsed a chunk at a time as they arrive, as
+    long as they don't use blank nodes, other formats are spooled to a
+    temporary file first.
+
+    returns how many statements the model grew by
+    """
+    def handler(stream, content_type):
+        before = model.size()
+        parser_name = guess_parser_name(content_type.split(';')[0].strip(), '')
+        if parser_name in LINE_FORMATS:
+            load_lines(model, stream, endpoint, parser_name)
+        else:
+            spool = spool_stream(stream)
+            try:
+                parse_source(RDF.Parser(name=parser_name), model,
+                             'file://' + spool, endpoint)
+            finally:
+                os.unlink(spool)
+        return model.size() - before
+    return post_query(endpoint, query, GRAPH_ACCEPT, handler, pool)
+
+def parse_sparql_results(stream, content_type):
+    """Parse a SPARQL results document from a binary stream
+    """
+    if content_type.startswith('application/sparql-results+xml'):
+        return parse_sparql_results_xml(stream)
+    elif content_type.startswith('text/tab-separated-values'):
+        return parse_sparql_results_tsv(stream)
+    return parse_sparql_results_json(stream)
+
+def make_node(kind, value, language=None, datatype=None):
+    """Make an RDF.Node from the parts of a SPARQL results term
+    """
+    if kind == 'uri':
+        return RDF.Node(uri_string=value)
+    elif kind == 'bnode':
+        return RDF.Node(blank=value)
+    options = {}
+    if language:
+        options['language'] = language
+    if datatype is not None:
+        options['datatype'] = RDF.Uri(datatype)
+    return RDF.Node(literal=value, **options)
+
+def parse_sparql_results_json(stream):
+    """Parse SPARQL results JSON
+
+    The whole document is loaded at once, so it is only asked for after
+    the formats that can be parsed incrementally.
+    """
+    document = json.loads(stream.read().decode('utf-8'))
+    if 'boolean' in document:
+        return document['boolean']
+    results = LibRdfResults(None)
+    results.set_columns(document['head']['vars'])
+    for binding in document['results']['bindings']:
+        row = []
+        for column in results.columns:
+            term = binding.get(column)
+            if term is None:
+                row.append(None)
+            else:
+                kind = term['type']
+                if kind == 'typed-literal':
+                    kind = 'literal'
+                row.append(make_node(kind, term['value'],
+                                     term.get('xml:lang'),
+                                     term.get('datatype')))
+        results.append_row(row)
+    return results
+
+SPARQL_RESULTS_NS = '{http://www.w3.org/2005/sparql-results#}'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+def parse_sparql_results_xml(stream):
+    """Parse SPARQL results XML, discarding each result once it is read
+    """
+    results = LibRdfResults(None)
+    columns = []
+    for event, element in ElementTree.iterparse(stream, events=('end',)):
+        tag = element.tag
+        if tag == SPARQL_RESULTS_NS + 'variable':
+            columns.append(element.get('name'))
+        elif tag == SPARQL_RESULTS_NS + 'head':
+            results.set_columns(columns)
+        elif tag == SPARQL_RESULTS_NS + 'boolean':
+            return element.text.strip() == 'true'
+        elif tag == SPARQL_RESULTS_NS + 'result':
+            values = {}
+            for binding in element:
+                term = binding[0]
+                kind = term.tag[len(SPARQL_RESULTS_NS):]
+                values[binding.get('name')] = make_node(
+                    kind, term.text or '', term.get(XML_LANG),
+                    term.get('datatype'))
+            results.append_row([values.get(c) for c in results.columns])
+            element.clear()
+    return results
+
+_tsv_term_re = re.compile(
+    r'^(?:<(?P<uri>[^>]*)>'
+    r'|_:(?P<bnode>\S+)'
+    r'|"(?P<literal>(?:[^"\\]|\\.)*)"'
+    r'(?:@(?P<language>[A-Za-z0-9-]+)|\^\^<(?P<datatype>[^>]*)>)?'
+    r'|(?P<bare>\S+))$')
+_tsv_escape_re = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+_tsv_escapes = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f'}
+
+def _unescape_literal(text):
+    def replace(match):
+        code = match.group(1) or match.group(2)
+        if code is not None:
+            return six.unichr(int(code, 16))
+        c = match.group(3)
+        return _tsv_escapes.get(c, c)
+    return _tsv_escape_re.sub(replace, text)
+
+def parse_tsv_term(text):
+    """Parse one term of a SPARQL results TSV document
+    """
+    if not text:
+        return None
+    match = _tsv_term_re.match(text)
+    if match is None:
+        raise ValueError("Unable to parse term {0}".format(text))
+    if match.group('uri') is not None:
+        return make_node('uri', match.group('uri'))
+    elif match.group('bnode') is not None:
+        return make_node('bnode', match.group('bnode'))
+    elif match.group('literal') is not None:
+        return make_node('literal', _unescape_literal(match.group('literal')),
+                         match.group('language'), match.group('datatype'))
+    # turtle style abbreviated numbers and booleans
+    bare = match.group('bare')
+    if bare in ('true', 'false'):
+        datatype = XSD + 'boolean'
+    elif re.match(r'^[+-]?\d+$', bare):
+        datatype = XSD + 'integer'
+    elif re.match(r'^[+-]?\d*\.\d+$', bare):
+        datatype = XSD + 'decimal'
+    else:
+        datatype = XSD + 'double'
+    return make_node('literal', bare, None, datatype)
+
+def parse_sparql_results_tsv(stream):
+    """Parse SPARQL results TSV one line at a time
+    """
+    results = LibRdfResults(None)
+    header = stream.readline().decode('utf-8').rstrip('\r\n')
+    results.set_columns([c.lstrip('?$') for c in header.split('\t')])
+    for line in stream:
+        line = line.decode('utf-8').rstrip('\r\n')
+        if not line:
+            continue
+        results.append_row([parse_tsv_term(t) for t in line.split('\t')])
+    return results
+
+
+_stats_hooks = []
+
+def add_stats_hook(func):
+    """Call func with every event recorded by a QueryStats
+
+    Events are dictionaries with an event key of phase, source or
+    summary. While any hook is registered %%sparql always collects stats.
+    """
+    _stats_hooks.append(func)
+
+def remove_stats_hook(func):
+    _stats_hooks.remove(func)
+
+def emit_stats_event(event):
+    logger.debug("%s", event)
+    for hook in list(_stats_hooks):
+        hook(event)
+
+def peak_rss():
+    """Peak resident set size of this process as reported by getrusage"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class QueryStats(object):
+    """Timings and counts collected while running a query
+
+    phases maps a phase name (fetch, parse, cache, query, results, render)
+    to the seconds spent in it, and sources holds the bytes read, triples
+    parsed and seconds taken by each source. peak_rss_delta is how much
+    the peak resident set size, in getrusage units, grew during the query.
+    """
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.sources = collections.OrderedDict()
+        self.values = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._start = None
+        self._start_rss = None
+
+    def start(self):
+        self._start = time.time()
+        self._start_rss = peak_rss()
+
+    def finish(self, results=None):
+        if self._start is not None:
+            self.set('seconds', time.time() - self._start)
+        if self._start_rss is not None:
+            self.set('peak_rss_delta', peak_rss() - self._start_rss)
+        if isinstance(results, LibRdfResults):
+            self.set('rows', results.fetched)
+        emit_stats_event(dict(self.as_dict(), event='summary'))
+
+    @contextlib.contextmanager
+    def phase(self, name, source=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start, source)
+
+    def add_time(self, name, seconds, source=None):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        emit_stats_event({'event': 'phase', 'phase': name,
+                          'seconds': seconds, 'source': source})
+
+    def update_source(self, source, **counts):
+        """Add counts such as bytes, triples or seconds for a source
+        """
+        with self._lock:
+            entry = self.sources.setdefault(source, {})
+            for key, value in counts.items():
+                entry[key] = entry.get(key, 0) + value
+        emit_stats_event(dict(counts, event='source', source=source))
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def as_dict(self):
+        with self._lock:
+            values = dict(self.values)
+            values['phases'] = dict(self.phases)
+            values['sources'] = dict((k, dict(v))
+                                     for k, v in self.sources.items())
+        return values
+
+    def __str__(self):
+        output = []
+        for name, seconds in self.phases.items():
+            output.append("{0:10} {1:.3f}s".format(name, seconds))
+        for source, counts in self.sources.items():
+            output.append("{0} {1}".format(source, " ".join(
+                "{0}={1}".format(k, v if not isinstance(v, float)
+                                 else "{0:.3f}".format(v))
+                for k, v in sorted(counts.items()))))
+        for name, value in self.values.items():
+            output.append("{0:10} {1}".format(name, value))
+        return os.linesep.join(output)
+
+
+class NullStats(QueryStats):
+    """Stand in for QueryStats that doesn't record anything"""
+    @contextlib.contextmanager
+    def phase(self, name, source=None):
+        yield
+
+    def add_time(self, name, seconds, source=None):
+        pass
+
+    def update_source(self, source, **counts):
+        pass
+
+    def set(self, name, value):
+        pass
+
+_null_stats = NullStats()
+
+
+class JobCancelled(Exception):
+    """Raised inside a background query after it has been cancelled"""
+
+
+class QueryJob(object):
+    """Handle for a %%sparql query running in the background
+
+    progress counts sources loaded and rows fetched so far. The job can be
+    cancelled, waited for with result(), or awaited from asyncio code.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.future = None
+        self.progress = {
+            'sources_loaded': 0,
+            'sources_total': 0,
+            'rows_fetched': 0,
+        }
+        self._cancelled = threading.Event()
+
+    def start(self, executor, func, *args):
+        self.future = executor.submit(func, *args)
+
+    def check(self):
+        """Stop the job from inside if it has been cancelled
+        """
+        if self._cancelled.is_set():
+            raise JobCancelled("Query for {0} was cancelled".format(self.output))
+
+    def cancel(self):
+        """Ask the job to stop at the next source or block of rows
+        """
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    @property
+    def status(self):
+        future = self.future
+        if future is None or not (future.running() or future.done()):
+            return 'pending'
+        if future.running():
+            return 'running'
+        if future.cancelled() or isinstance(future.exception(), JobCancelled):
+            return 'cancelled'
+        if future.exception() is not None:
+            return 'failed'
+        return 'finished'
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def result(self, timeout=None):
+        """Wait for the job to finish, raising any error it hit
+        """
+        self.future.result(timeout)
+
+    def __await__(self):
+        import asyncio
+        return asyncio.wrap_future(self.future).__await__()
+
+    def __repr__(self):
+        return "<QueryJob {0} {1}: {2}/{3} sources, {4} rows>".format(
+            self.output, self.status,
+            self.progress['sources_loaded'], self.progress['sources_total'],
+            self.progress['rows_fetched'])
+
+
+_background_executor = None
+def get_background_executor():
+    global _background_executor
+    if _background_executor is None:
+        _background_executor = ThreadPoolExecutor(
+            max_workers=get_option('background.workers'))
+    return _background_executor
+
+
+_source_cache = None
+def get_source_cache():
+    """Return the source cache configured by the options, or None if disabled
+    """
+    global _source_cache
+    if not get_option('cache.enabled'):
+        return None
+    directory = get_option('cache.dir')
+    if _source_cache is None or _source_cache.directory != directory:
+        if _source_cache is not None:
+            _source_cache.flush()
+        _source_cache = SourceCache(directory, get_option('cache.max_size'))
+    _source_cache.max_size = get_option('cache.max_size')
+    return _source_cache
+
+
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.zst': 'zstd',
+}
+
+def split_compression(pathname):
+    """Return pathname without its compression extension, and the compression
+    """
+    base, ext = os.path.splitext(pathname)
+    compression = COMPRESSION_EXTENSIONS.get(ext.lower())
+    if compression is None:
+        return pathname, None
+    return base, compression
+
+def decompress_stream(stream, compression):
+    """Wrap a binary stream so reads return decompressed data
+    """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    elif compression == 'bz2':
+        import bz2
+        return bz2.BZ2File(stream)
+    elif compression == 'xz':
+        import lzma
+        return lzma.LZMAFile(stream)
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise ValueError("Unknown compression {0}".format(compression))
+
+def open_compressed(pathname, compression, mode='rb'):
+    """Open a binary file through a compression library
+    """
+    if compression is None:
+        return open(pathname, mode)
+    elif compression == 'gzip':
+        return gzip.open(pathname, mode)
+    elif compression == 'bz2':
+        import bz2
+        return bz2.BZ2File(pathname, mode)
+    elif compression == 'xz':
+        import lzma
+        return lzma.open(pathname, mode)
+    elif compression == 'zstd':
+        import zstandard
+        if mode.startswith('r'):
+            return zstandard.ZstdDecompressor().stream_reader(
+                open(pathname, 'rb'), closefd=True)
+        return zstandard.ZstdCompressor().stream_writer(
+            open(pathname, 'wb'), closefd=True)
+    raise ValueError("Unknown compression {0}".format(compression))
+
+def guess_serializer_name_by_extension(pathname):
+    base, _ = split_compression(pathname)
+    _, ext = os.path.splitext(base)
+    if ext in ('.xml', '.rdf'):
+        return 'rdfxml-abbrev'
+    elif ext in ('.turtle', '.ttl'):
+        return 'turtle'
+    elif ext == '.nt':
+        return 'ntriples'
+    elif ext == '.nq':
+        return 'nquads'
+    return None
+
+def save_model(model, pathname, name=None):
+    """Serialize model to pathname, compressing it if the extension asks
+
+    If the format isn't given it is guessed from the extension. Without
+    a known extension large models are written as N-Triples, which is
+    the quickest to write and to read back. librdf writes directly to a
+    file, so compressed output goes through a temporary file that is then
+    compressed in chunks.
+    """
+    if name is None:
+        name = guess_serializer_name_by_extension(pathname)
+    if name is None:
+        if len(model) > get_option('save.large_model'):
+            name = 'ntriples'
+        else:
+            name = 'turtle'
+    serializer = RDF.Serializer(name=name)
+    if name in ('turtle', 'rdfxml-abbrev'):
+        for prefix, namespace in _prefixes.items():
+            serializer.set_namespace(prefix, namespace)
+
+    _, compression = split_compression(pathname)
+    if compression is None:
+        serializer.serialize_model_to_file(pathname, model)
+        return name
+
+    directory = os.path.dirname(os.path.abspath(pathname))
+    handle, temp = tempfile.mkstemp(prefix='.rdfmagic_', dir=directory)
+    os.close(handle)
+    try:
+        serializer.serialize_model_to_file(temp, model)
+        with open(temp, 'rb') as instream:
+            with open_compressed(pathname, compression, 'wb') as outstream:
+                shutil.copyfileobj(instream, outstream, 1024 * 1024)
+    finally:
+        os.unlink(temp)
+    return name
+
+def guess_parser(content_type, pathname):
+    name = guess_parser_name(content_type, pathname)
+    return RDF.Parser(name=name)
+
+
+def guess_parser_name(content_type, pathname):
+    if content_type is None or content_type.startswith('text/plain') or \
+       content_type.startswith('application/octet-stream') or \
+       content_type.startswith('application/gzip') or \
+       content_type.startswith('application/x-gzip'):
+        return guess_parser_name_by_extension(pathname)
+    if content_type.startswith('application/n-triples'):
+        return 'ntriples'
+    elif content_type.startswith('application/n-quads') or \
+         content_type.startswith('text/x-nquads'):
+        return 'nquads'
+    elif content_type.startswith('application/rdf+xml'):
+        return 'rdfxml'
+    elif content_type.startswith('application/x-turtle'):
+        return 'turtle'
+    elif content_type.startswith('text/turtle'):
+        return 'turtle'
+    elif content_type.startswith('text/html'):
         return 'rdfa'
     else:
         return 'guess'
 
 def guess_parser_name_by_extension(pathname):
+    pathname, _ = split_compression(pathname)
     _, ext = os.path.splitext(pathname)
-    if ext in ('.xml', '.rdf'):
+    if ext == '.nt':
+        return 'ntriples'
+    elif ext == '.nq':
+        return 'nquads'
+    elif ext in ('.xml', '.rdf'):
         return 'rdfxml'
     elif ext in ('.html','.xhtml'):
         return 'rdfa'
@@ -15,13 +15,35 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor, Boston,
 # MA 02110-1301 USA
 
+import gc
+import gzip
+import io
+import json
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 import RDF
 
+from six.moves import BaseHTTPServer
+from six.moves.urllib.parse import parse_qs
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pandas
+except ImportError:
+    pandas = None
+try:
+    import ipywidgets
+except ImportError:
+    ipywidgets = None
+
 import rdfmagic
+from IPython.core.error import UsageError
 from IPython.core.interactiveshell import InteractiveShell
 
 testdata = '''
@@ -42,6 +64,24 @@ testdata = '''
     foaf:name "Spiderman", "Человек-паук"@ru .
 '''
 
+typeddata = '''
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+@prefix ex: <http://example.org/> .
+
+ex:a ex:count "1"^^xsd:integer ; ex:weight "1.5"^^xsd:double .
+ex:b ex:count "2"^^xsd:integer ; ex:weight "2.5"^^xsd:double .
+ex:c ex:count "3"^^xsd:integer .
+'''
+
+TYPED_QUERY = '''
+prefix ex: <http://example.org/>
+select ?s ?count ?weight
+where {
+  ?s ex:count ?count .
+  optional { ?s ex:weight ?weight . }
+}
+order by ?count'''
+
 
 class TestRDFMagic(unittest.TestCase):
     def setUp(self):
@@ -50,6 +90,8 @@ class TestRDFMagic(unittest.TestCase):
         self.tempurl = 'file://' + self.tempfile
         with open(self.tempfile, 'w') as outstream:
             outstream.write(testdata)
+        self.cache_dir = rdfmagic.get_option('cache.dir')
+        rdfmagic.set_option('cache.dir', os.path.join(self.tempdir, 'cache'))
 
         self.shell = InteractiveShell()
         self.magic = rdfmagic.SPARQLMagics(self.shell)
@@ -60,6 +102,7 @@ class TestRDFMagic(unittest.TestCase):
             self.magic.addns(ns_cmd)
 
     def tearDown(self):
+        rdfmagic.set_option('cache.dir', self.cache_dir)
         shutil.rmtree(self.tempdir)
 
     def test_sources_literal(self):
@@ -118,11 +161,614 @@ class TestRDFMagic(unittest.TestCase):
         froms, new_q = rdfmagic.extract_froms(q)
         self.assertEqual(new_q, "select  from named <def>  where")
 
+    def test_sparql_template(self):
+        template = rdfmagic.sparql_template(
+            """select ?o from <{}>
+               where {{ $s <http://xmlns.com/foaf/0.1/name> ?o . }}""".format(
+                   self.tempurl))
+        self.assertEqual(template.parameters, ['s'])
+        self.assertEqual(template.sources, [self.tempurl])
+
+        goblin = RDF.Node(uri_string='http://example.org/#green-goblin')
+        results = template(s=goblin)
+        self.assertEqual(len(results), 1)
+        self.assertRaises(KeyError, template.bind)
+        self.assertRaises(ValueError, template.bind, s=RDF.Uri('http://x> ?p'))
+
+        spiderman = RDF.Node(uri_string='http://example.org/#spiderman')
+        batch = template.execute_many([{'s': goblin}, {'s': spiderman}])
+        self.assertEqual([len(r) for r in batch], [1, 2])
+
+    def test_sparql_template_magic(self):
+        self.shell.user_ns['url'] = self.tempurl
+        template = self.magic.sparql(
+            '-s url --template by_name',
+            'select ?s where { ?s <http://xmlns.com/foaf/0.1/name> $name . }')
+        self.assertIs(self.shell.user_ns['by_name'], template)
+        self.assertEqual(len(template(name='Spiderman')), 1)
+        self.assertEqual(
+            rdfmagic.sparql_term(RDF.Node(literal='паук', language='ru')),
+            '"паук"@ru')
+
+    def test_sparql_bind(self):
+        self.shell.user_ns['url'] = self.tempurl
+        self.magic.sparql(
+            '-s url -o people',
+            'select ?s where { ?s a <http://xmlns.com/foaf/0.1/Person> . }')
+        query = 'select ?s ?name where { ?s <http://xmlns.com/foaf/0.1/name> ?name . }'
+        results = self.magic.sparql('-s url --bind people', query)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results.columns, ['s', 'name'])
+
+        self.shell.user_ns['nobody'] = rdfmagic.LibRdfResults.from_rows(['s'], [])
+        results = self.magic.sparql('-s url --bind nobody', query)
+        self.assertEqual(len(results), 0)
+        self.assertEqual(results.columns, ['s', 'name'])
+
+        batch_size = rdfmagic.get_option('bind.batch_size')
+        rdfmagic.set_option('bind.batch_size', 1)
+        try:
+            queries = []
+            def execute(text):
+                queries.append(text)
+                return self.magic.sparql('-s url --no-cache', text)
+            results = rdfmagic.run_bound_query(
+                query, self.shell.user_ns['people'], execute)
+        finally:
+            rdfmagic.set_option('bind.batch_size', batch_size)
+        self.assertEqual(len(queries), 2)
+        self.assertIn('VALUES (?s)', queries[0])
+        self.assertEqual(len(results), 3)
+
+        self.assertRaises(UsageError, self.magic.sparql, '-s url --bind people',
+                          query + ' LIMIT 1')
+        self.shell.user_ns['blanks'] = rdfmagic.LibRdfResults.from_rows(
+            ['s'], [{'s': RDF.Node(blank='b1')}])
+        self.assertRaises(UsageError, self.magic.sparql, '-s url --bind blanks',
+                          query)
+
+    def test_write_results(self):
+        query = "select ?s ?p ?o where { ?s ?p ?o . }"
+        self.shell.user_ns['url'] = self.tempurl
+        results = self.magic.sparql('-s url', query)
+        pathname = os.path.join(self.tempdir, 'results.jsonl')
+        self.assertEqual(results.write(pathname, batch_size=2), 7)
+        with open(pathname, 'rb') as instream:
+            rows = [json.loads(line.decode('utf-8')) for line in instream]
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(set(rows[0].keys()), {'s', 'p', 'o'})
+
+        pathname = os.path.join(self.tempdir, 'results.tsv.gz')
+        self.magic.sparql('-s url --lazy --curies --export ' + pathname, query)
+        with gzip.open(pathname, 'rb') as instream:
+            lines = instream.read().decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 's\tp\to')
+        self.assertEqual(len(lines), 8)
+        self.assertTrue(any('rdf:type' in line for line in lines))
+
+        # rows streamed past the ones already read aren't kept
+        results = self.magic.sparql('-s url --lazy', query)
+        results.fetch(2)
+        pathname = os.path.join(self.tempdir, 'results.csv')
+        self.assertEqual(results.write(pathname), 7)
+        self.assertRaises(ValueError, len, results)
+        self.assertRaises(ValueError, list, results)
+
+        self.assertRaises(ValueError, rdfmagic.export_rows,
+                          os.path.join(self.tempdir, 'results.parquet.gz'),
+                          ['s'], iter([]))
+
+    def test_sparql_into(self):
+        self.shell.user_ns['url'] = self.tempurl
+        self.magic.sparql(
+            '-s url --into names',
+            """construct { ?s <http://example.org/label> ?name . }
+               where { ?s <http://xmlns.com/foaf/0.1/name> ?name . }""")
+        names = self.shell.user_ns['names']
+        self.assertIsInstance(names, RDF.Model)
+        self.assertEqual(len(names), 3)
+
+        results = self.magic.sparql(
+            '-m names', 'select ?s where { ?s ?p ?o . }')
+        self.assertEqual(len(results), 3)
+        self.assertRaises(UsageError, self.magic.sparql, '-s url --into names',
+                          'select ?s where { ?s ?p ?o . }')
+        self.assertRaises(UsageError, self.magic.sparql, '-m names --into names',
+                          'construct { ?s ?p ?o . } where { ?s ?p ?o . }')
+
+    def test_federate(self):
+        other = os.path.join(self.tempdir, 'other.ttl')
+        with open(other, 'w') as outstream:
+            outstream.write(
+                '<http://example.org/#venom> '
+                '<http://xmlns.com/foaf/0.1/name> "Venom" .\n'
+                '<http://example.org/#spiderman> '
+                '<http://xmlns.com/foaf/0.1/name> "Spiderman" .\n')
+        self.shell.user_ns['a'] = rdfmagic.make_temp_model()
+        self.shell.user_ns['b'] = rdfmagic.make_temp_model()
+        self.magic.load_source('-m a ' + self.tempurl)
+        self.magic.load_source('-m b ' + other)
+
+        query = """select {0} ?name
+                   where {{ ?s <http://xmlns.com/foaf/0.1/name> ?name . }}
+                   order by desc(?name) {1}"""
+        results = self.magic.sparql('-m a,b --federate', query.format('', ''))
+        names = [str(row['name']) for row in results]
+        self.assertEqual(len(names), 5)
+        self.assertEqual(names, sorted(names, reverse=True))
+
+        results = self.magic.sparql('-m a,b --federate',
+                                    query.format('distinct', 'limit 3'))
+        self.assertEqual([str(row['name']) for row in results],
+                         sorted(set(names), reverse=True)[:3])
+        self.assertRaises(UsageError, self.magic.sparql, '-m a,b', query)
+        self.assertRaises(
+            UsageError, self.magic.sparql, '-m a,b --federate',
+            """select ?s (count(?o) as ?n) where { ?s ?p ?o . }
+               group by ?s order by desc(?n)""")
+        self.assertFalse(rdfmagic.has_aggregates(
+            'select ?s where { ?s ?p "count(x) group by" . }'))
+
+        # a DISTINCT subquery doesn't make the outer query distinct
+        results = self.magic.sparql(
+            '-m a,b --federate',
+            """select ?name where {
+                 { select distinct ?name
+                   where { ?s <http://xmlns.com/foaf/0.1/name> ?name . } } }""")
+        self.assertEqual(len(results), len(names))
+        self.assertFalse(rdfmagic.is_distinct(
+            'select * where { { select distinct ?s where { ?s ?p ?o } } }'))
+        self.assertTrue(rdfmagic.is_distinct(
+            'SELECT REDUCED ?s where { ?s ?p "select" }'))
+        self.assertRaises(UsageError, self.magic.sparql,
+                          '-m a,b --federate --bind people', query)
+
     def test_load_source_magic(self):
         self.shell.user_ns['model'] = RDF.Model(RDF.MemoryStorage())
         self.magic.load_source('-m model '+self.tempurl)
         self.assertEqual(len(self.shell.user_ns['model']), 7)
 
+    def test_lazy_slices(self):
+        query = "select ?s ?p ?o where { ?s ?p ?o . }"
+        results = self.magic.sparql('--lazy --no-cache -s ' + self.tempurl, query)
+        backwards = results[5:2:-1]
+        self.assertEqual(results.fetched, 6)
+        self.assertEqual(len(backwards), 3)
+        self.assertEqual(str(backwards[0]['s']), str(results[5]['s']))
+
+        results = self.magic.sparql('--lazy --no-cache -s ' + self.tempurl, query)
+        self.assertEqual(len(results[::-1]), 7)
+
+    def test_lazy_results(self):
+        results = self.magic.sparql(
+            '--lazy -s ' + self.tempurl,
+            "select ?s ?p ?o where { ?s ?p ?o . }")
+        self.assertEqual(set(results[0].keys()), {'s', 'p', 'o'})
+        self.assertEqual(results.fetched, 1)
+        self.assertFalse(results.exhausted)
+        self.assertEqual(len(results), 7)
+        self.assertEqual(results.fetched, 1)
+        self.assertEqual(len(list(results)), 7)
+        self.assertTrue(results.exhausted)
+        # finished results don't keep the model alive
+        self.assertIsNone(results._model)
+
+    def test_columnar_results(self):
+        results = self.magic.sparql(
+            '-s ' + self.tempurl,
+            "select ?s ?p ?o where { ?s ?p ?o . }")
+        self.assertIsNone(results._model)
+        # unbound, 2 subjects, 3 predicates and 4 objects that aren't subjects
+        self.assertEqual(len(results._values), 1 + 2 + 3 + 4)
+        row = results[0]
+        self.assertEqual(list(row.keys()), ['s', 'p', 'o'])
+        self.assertEqual(row.values(), results.results[0])
+        self.assertEqual(len(results[-2:]), 2)
+        self.assertEqual(str(results[-1]['s']), str(results.results[6][0]))
+
+    def make_typed_source(self):
+        pathname = os.path.join(self.tempdir, 'typed.ttl')
+        with open(pathname, 'w') as outstream:
+            outstream.write(typeddata)
+        return 'file://' + pathname
+
+    @unittest.skipIf(numpy is None, 'numpy not installed')
+    def test_to_numpy(self):
+        results = self.magic.sparql('-s ' + self.make_typed_source(),
+                                    TYPED_QUERY)
+        records = results.to_numpy()
+        self.assertEqual(records['count'].dtype, numpy.int64)
+        self.assertEqual(list(records['count']), [1, 2, 3])
+        self.assertEqual(records['weight'].dtype, numpy.float64)
+        self.assertTrue(numpy.isnan(records['weight'][2]))
+        self.assertEqual(records['s'][0], 'http://example.org/a')
+
+    @unittest.skipIf(pandas is None, 'pandas not installed')
+    def test_to_dataframe(self):
+        frame = self.magic.sparql('--as dataframe -s ' + self.make_typed_source(),
+                                  TYPED_QUERY)
+        self.assertEqual(str(frame['s'].dtype), 'category')
+        self.assertEqual(list(frame['count']), [1, 2, 3])
+
+    @unittest.skipIf(ipywidgets is None, 'ipywidgets not installed')
+    def test_pager(self):
+        results = self.magic.sparql(
+            '--lazy --no-cache -s ' + self.tempurl,
+            "select ?s ?p ?o where { ?s ?p ?o . }")
+        selector = results.pager(page_size=2).children[0]
+        # the last page grows as pages are read instead of counting rows
+        self.assertEqual(selector.max, 2)
+        self.assertIsNone(results._count)
+        for page in (2, 3, 4):
+            selector.value = page
+        self.assertTrue(results.exhausted)
+        self.assertEqual(selector.max, 4)
+
+    def test_display_window(self):
+        results = self.magic.sparql(
+            '-s ' + self.tempurl,
+            "select ?s ?p ?o where { ?s ?p ?o . }")
+        max_rows = rdfmagic.get_option('display.max_rows')
+        try:
+            rdfmagic.set_option('display.max_rows', 4)
+            head, tail, hidden = results.display_window()
+            self.assertEqual((len(head), len(tail), hidden), (2, 2, 3))
+            self.assertIn('3 more rows', str(results))
+            self.assertIn('3 more rows', results._repr_html_())
+
+            lazy = self.magic.sparql(
+                '--lazy --no-cache -s ' + self.tempurl,
+                "select ?s ?p ?o where { ?s ?p ?o . }")
+            head, tail, hidden = lazy.display_window()
+            self.assertEqual((len(head), len(tail), hidden), (4, 0, None))
+            self.assertIn('more rows', str(lazy))
+            # displaying doesn't count the rows by running the query again
+            self.assertEqual(lazy.fetched, 5)
+            self.assertIsNone(lazy._count)
+        finally:
+            rdfmagic.set_option('display.max_rows', max_rows)
+
+    def test_results_page(self):
+        results = self.magic.sparql(
+            '--lazy -s ' + self.tempurl,
+            "select ?s ?p ?o where { ?s ?p ?o . }")
+        page = results.page(1, page_size=3)
+        self.assertEqual(len(page.rows), 3)
+        self.assertEqual(results.fetched, 6)
+        self.assertIn('rows 4-6 of 7, page 2 of 3', str(page))
+        self.assertEqual(len(results.page(2, page_size=3).rows), 1)
+        self.assertRaises(IndexError, results.page, 3, 3)
+
+    def test_query_cache(self):
+        query = "select ?s ?p ?o where { ?s ?p ?o . }"
+        first = self.magic.sparql('-s ' + self.tempurl, query)
+        second = self.magic.sparql('-s ' + self.tempurl,
+                                   "select ?s ?p ?o  # everything\n"
+                                   "where { ?s ?p ?o . }")
+        self.assertIs(first, second)
+        self.assertEqual(self.magic.query_cache.stats()['hits'], 1)
+
+        third = self.magic.sparql('--no-cache -s ' + self.tempurl, query)
+        self.assertIsNot(first, third)
+
+        # changes made through the RDF API aren't hidden by the cache
+        self.shell.user_ns['model'] = rdfmagic.make_temp_model()
+        self.magic.load_source('-m model ' + self.tempurl)
+        before = self.magic.sparql('-m model', query)
+        self.shell.user_ns['model'].append(RDF.Statement(
+            RDF.Node(uri_string='http://example.org/a'),
+            RDF.Node(uri_string='http://example.org/b'),
+            RDF.Node(literal='c')))
+        after = self.magic.sparql('-m model', query)
+        self.assertEqual((len(before), len(after)), (7, 8))
+
+        # results streamed away by write() aren't handed out again
+        lazy = self.magic.sparql('--lazy -m model', 'select ?s where { ?s ?p ?o . }')
+        pathname = os.path.join(self.tempdir, 'cached.tsv')
+        self.magic.sparql('--lazy -m model --export ' + pathname,
+                          'select ?s where { ?s ?p ?o . }')
+        self.assertFalse(lazy.consumed)
+        lazy.write(pathname)
+        self.assertTrue(lazy.consumed)
+        again = self.magic.sparql('--lazy -m model', 'select ?s where { ?s ?p ?o . }')
+        self.assertIsNot(lazy, again)
+        self.assertEqual(len(again), 8)
+
+    def test_normalize_query(self):
+        self.assertEqual(
+            rdfmagic.normalize_query('select ?s # where\n where { ?s <http://a#b> "c  #d" }'),
+            'select ?s where { ?s <http://a#b> "c  #d" }')
+
+    def test_background_query(self):
+        job = self.magic.sparql(
+            '--background -o found -s ' + self.tempurl,
+            "select ?s ?p ?o where { ?s ?p ?o . }")
+        job.result(timeout=60)
+        self.assertEqual(job.status, 'finished')
+        self.assertEqual(job.progress['sources_loaded'], 1)
+        self.assertEqual(job.progress['rows_fetched'], 7)
+        self.assertEqual(len(self.shell.user_ns['found']), 7)
+
+    def test_background_queries_share_model(self):
+        query = "select ?s ?p ?o where { ?s ?p ?o . }"
+        jobs = [self.magic.sparql(
+                    '--background -o found{0} -s {1}'.format(i, self.tempurl),
+                    query)
+                for i in range(2)]
+        for job in jobs:
+            job.result(timeout=60)
+        entries = self.magic.models.entries()
+        self.assertEqual(len(entries), 1)
+        # the source was only loaded once
+        self.assertEqual(entries[0].generation, 1)
+        self.assertEqual(len(entries[0].model), 7)
+
+    def test_cancel_query_job(self):
+        job = rdfmagic.QueryJob('found')
+        job.check()
+        job.cancel()
+        self.assertRaises(rdfmagic.JobCancelled, job.check)
+
+    def test_profile(self):
+        events = []
+        rdfmagic.add_stats_hook(events.append)
+        try:
+            results = self.magic.sparql(
+                '--profile -s ' + self.tempurl,
+                "select ?s ?p ?o where { ?s ?p ?o . }")
+        finally:
+            rdfmagic.remove_stats_hook(events.append)
+        stats = results.stats
+        self.assertIn('parse', stats.phases)
+        self.assertIn('query', stats.phases)
+        self.assertEqual(stats.sources[self.tempurl]['triples'], 7)
+        self.assertEqual(stats.values['rows'], 7)
+        self.assertEqual(events[-1]['event'], 'summary')
+
+        results._repr_html_()
+        self.assertIn('render', stats.phases)
+
+    def test_model_registry_reuse(self):
+        self.shell.user_ns['url'] = self.tempurl
+        query = "select ?s ?p ?o where { ?s ?p ?o . }"
+        self.magic.sparql('-s url', query)
+        self.magic.sparql('-s url', query)
+        entries = self.magic.models.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0].generation, 1)
+        self.assertEqual(len(entries[0].model), 7)
+
+        self.magic.rdfmodels('--drop')
+        self.assertEqual(len(self.magic.models.entries()), 0)
+
+    def test_load_source_skips_loaded(self):
+        self.shell.user_ns['model'] = RDF.Model(RDF.MemoryStorage())
+        self.magic.load_source('-m model '+self.tempurl)
+        self.magic.load_source('-m model '+self.tempurl)
+        self.assertEqual(self.magic.models.entries()[0].generation, 1)
+
+        self.magic.rdfmodels('--drop model')
+        self.magic.load_source('-m model '+self.tempurl)
+        self.assertEqual(self.magic.models.entries()[0].generation, 1)
+
+    def test_registry_forgets_freed_models(self):
+        self.shell.user_ns['model'] = rdfmagic.make_temp_model()
+        self.magic.load_source('-m model '+self.tempurl)
+        self.assertIsNotNone(self.magic.models.find('model'))
+        del self.shell.user_ns['model']
+        gc.collect()
+        self.assertIsNone(self.magic.models.find('model'))
+
+    def test_load_source_refresh(self):
+        source = os.path.join(self.tempdir, 'refresh.ttl')
+        with open(source, 'w') as outstream:
+            outstream.write('<http://example.org/a> <http://example.org/b> "c" .')
+        self.shell.user_ns['model'] = rdfmagic.make_temp_model(contexts=True)
+        self.magic.load_source('-m model {0} {1}'.format(self.tempurl, source))
+        model = self.shell.user_ns['model']
+        self.assertEqual(len(model), 8)
+
+        info = os.stat(source)
+        with open(source, 'w') as outstream:
+            outstream.write('<http://example.org/a> <http://example.org/b> "d" .\n'
+                            '<http://example.org/a> <http://example.org/b> "e" .')
+        os.utime(source, (info.st_atime, info.st_mtime + 10))
+        self.magic.load_source('-m model --refresh')
+        self.assertEqual(self.magic.models.entries()[0].generation, 2)
+        self.assertEqual(len(model), 9)
+
+        # touched but unchanged files aren't reloaded
+        os.utime(source, (info.st_atime, info.st_mtime + 20))
+        self.magic.load_source('-m model --refresh')
+        self.assertEqual(self.magic.models.entries()[0].generation, 2)
+        self.assertEqual(len(model), 9)
+
+    def test_load_stats(self):
+        rdfmagic.set_option('load.stats', True)
+        try:
+            self.shell.user_ns['model'] = rdfmagic.make_temp_model()
+            self.magic.load_source('-m model ' + self.tempurl)
+        finally:
+            rdfmagic.set_option('load.stats', False)
+        entry = self.magic.models.find('model')
+        summary = entry.stats[self.tempurl]
+        self.assertEqual(summary.triples, 7)
+        self.assertEqual(summary.classes['http://xmlns.com/foaf/0.1/Person'], 2)
+        self.assertEqual(summary.subjects.count(), 2)
+        self.assertIn('http://xmlns.com/foaf/0.1/', summary.namespaces())
+
+        copy = rdfmagic.DatasetStats.from_dict(
+            json.loads(json.dumps(summary.as_dict())))
+        self.assertEqual(copy.objects.count(), summary.objects.count())
+
+        self.magic.rdfstats('model')
+        void = os.path.join(self.tempdir, 'void.ttl')
+        self.magic.rdfstats('model --void ' + void)
+        self.assertTrue(os.path.getsize(void) > 0)
+
+    def test_load_sources_parallel(self):
+        other = os.path.join(self.tempdir, 'other.ttl')
+        with open(other, 'w') as outstream:
+            outstream.write('<http://example.org/a> <http://example.org/b> "c" .')
+        missing = 'file://' + os.path.join(self.tempdir, 'missing.ttl')
+
+        model = rdfmagic.make_temp_model()
+        errors = rdfmagic.load_sources(
+            model, [self.tempurl, missing, 'file://' + other], jobs=3)
+        self.assertEqual(len(model), 8)
+        self.assertEqual(list(errors.keys()), [missing])
+
+    def test_on_disk_model(self):
+        path = os.path.join(self.tempdir, 'store')
+        try:
+            RDF.HashStorage('probe', options="new='yes',hash-type='bdb',"
+                            "dir='{0}'".format(self.tempdir))
+        except RDF.RedlandError as e:
+            self.skipTest('hashes storage unavailable: {0}'.format(e))
+        self.magic.rdfmodel('create disk --storage hashes --path ' + path)
+        self.magic.load_source('-m disk ' + self.tempurl)
+        self.magic.rdfmodel('close disk')
+        self.assertNotIn('disk', self.shell.user_ns)
+
+        magic = rdfmagic.SPARQLMagics(self.shell)
+        magic.rdfmodel('open disk --path ' + path)
+        self.assertEqual(len(self.shell.user_ns['disk']), 7)
+        # the store remembers what was loaded into it
+        magic.load_source('-m disk ' + self.tempurl)
+        self.assertEqual(magic.models.generation(self.shell.user_ns['disk']), 0)
+        results = magic.sparql('-m disk', 'select ?s where { ?s ?p ?o }')
+        self.assertEqual(len(results), 7)
+        magic.rdfmodel('close disk')
+
+    def test_source_cache(self):
+        self.assertIsNone(rdfmagic.get_source_cache())
+        rdfmagic.set_option('cache.enabled', True)
+        try:
+            cache = rdfmagic.get_source_cache()
+            model = rdfmagic.make_temp_model()
+            rdfmagic.load_source(model, self.tempurl)
+            self.assertEqual(cache.misses, 1)
+            self.assertIsNotNone(cache.lookup(self.tempurl))
+            index = os.path.join(cache.directory, cache.index_name)
+            with open(index) as instream:
+                written = instream.read()
+
+            model = rdfmagic.make_temp_model()
+            rdfmagic.load_source(model, self.tempurl)
+            self.assertEqual(len(model), 7)
+            self.assertEqual(cache.hits, 1)
+            # hits only update the index once it is flushed
+            with open(index) as instream:
+                self.assertEqual(instream.read(), written)
+            cache.flush()
+            with open(index) as instream:
+                self.assertNotEqual(instream.read(), written)
+
+            cache.pin(self.tempurl)
+            self.magic.rdfcache('purge')
+            self.assertEqual(cache.stats()['entries'], 1)
+            self.magic.rdfcache('purge --all')
+            self.assertEqual(cache.stats()['entries'], 0)
+        finally:
+            rdfmagic.set_option('cache.enabled', False)
+
+    def test_source_cache_eviction(self):
+        cache = rdfmagic.SourceCache(os.path.join(self.tempdir, 'lru'), 0)
+        model = rdfmagic.make_temp_model()
+        rdfmagic.load_source(model, self.tempurl, cache=cache)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_namespace_index(self):
+        index = rdfmagic.NamespaceIndex({
+            'http://example.org/': 'ex',
+            'http://example.org/people/': 'people',
+        })
+        self.assertEqual(index.shorten('http://example.org/people/diane'),
+                         'people:diane')
+        self.assertEqual(index.shorten('http://example.org/thing'), 'ex:thing')
+        # only the leading namespace is replaced
+        self.assertEqual(index.shorten('http://example.org/x/http://example.org/'),
+                         'ex:x/http://example.org/')
+        self.assertEqual(index.shorten('http://other.org/'), 'http://other.org/')
+        index.remove('http://example.org/people/')
+        self.assertEqual(index.shorten('http://example.org/people/diane'),
+                         'ex:people/diane')
+
+    def test_addns_delns(self):
+        node = RDF.Node(RDF.Uri('http://jumpgate.caltech.edu/library/10001'))
+        self.assertEqual(rdfmagic.display_node(node, 'text/plain'),
+                         'htslib:10001')
+        self.magic.delns('htslib')
+        self.assertEqual(rdfmagic.display_node(node, 'text/plain'),
+                         'http://jumpgate.caltech.edu/library/10001')
+        self.assertNotIn('htslib', self.shell.user_ns)
+
+    def test_save_model(self):
+        self.shell.user_ns['model'] = RDF.Model(RDF.MemoryStorage())
+        self.magic.load_source('-m model '+self.tempurl)
+
+        turtle = os.path.join(self.tempdir, 'saved.ttl')
+        self.magic.save_model('-m model ' + turtle)
+        reloaded = rdfmagic.make_temp_model()
+        RDF.Parser(name='turtle').parse_into_model(reloaded, 'file://' + turtle)
+        self.assertEqual(len(reloaded), 7)
+
+        compressed = os.path.join(self.tempdir, 'saved.nt.gz')
+        self.magic.save_model('-m model ' + compressed)
+        with gzip.open(compressed, 'rb') as instream:
+            body = instream.read().decode('utf-8')
+        self.assertEqual(len(body.strip().split('\n')), 7)
+
+    def test_load_compressed_ntriples(self):
+        lines = ['<http://example.org/s{0}> <http://example.org/p> "{0}" .\n'.format(i)
+                 for i in range(100)]
+        pathname = os.path.join(self.tempdir, 'lines.nt.gz')
+        with gzip.open(pathname, 'wb') as outstream:
+            outstream.write(''.join(lines).encode('utf-8'))
+
+        model = rdfmagic.make_temp_model()
+        rdfmagic.load_source(model, pathname)
+        self.assertEqual(len(model), 100)
+
+        model = rdfmagic.make_temp_model()
+        with gzip.open(pathname, 'rb') as instream:
+            rdfmagic.load_lines(model, instream, 'file://' + pathname,
+                                chunk_size=100, jobs=2)
+        self.assertEqual(len(model), 100)
+
+    def test_load_lines_blank_nodes(self):
+        # the two uses of _:b1 end up in different chunks
+        lines = ['<http://example.org/s{0}> <http://example.org/p> "{0}" .\n'.format(i)
+                 for i in range(50)]
+        lines.insert(10, '_:b1 <http://example.org/q> "first" .\n')
+        lines.append('_:b1 <http://example.org/q> "last" .\n')
+        model = rdfmagic.make_temp_model()
+        stream = io.BytesIO(''.join(lines).encode('utf-8'))
+        rdfmagic.load_lines(model, stream, 'http://example.org/',
+                            chunk_size=100, jobs=2)
+        self.assertEqual(len(model), 52)
+        blanks = model.find_statements(RDF.Statement(
+            None, RDF.Node(uri_string='http://example.org/q'), None))
+        self.assertEqual(len(set(str(s.subject) for s in blanks)), 1)
+
+    def test_load_compressed_turtle(self):
+        pathname = os.path.join(self.tempdir, 'spiderman.ttl.bz2')
+        import bz2
+        with bz2.BZ2File(pathname, 'wb') as outstream:
+            outstream.write(testdata.encode('utf-8'))
+        model = rdfmagic.make_temp_model()
+        rdfmagic.load_source(model, pathname)
+        self.assertEqual(len(model), 7)
+
+    def test_guess_serializer(self):
+        self.assertEqual(rdfmagic.guess_serializer_name_by_extension('a.ttl'),
+                         'turtle')
+        self.assertEqual(rdfmagic.guess_serializer_name_by_extension('a.nt.gz'),
+                         'ntriples')
+        self.assertEqual(rdfmagic.guess_serializer_name_by_extension('a.rdf.bz2'),
+                         'rdfxml-abbrev')
+        self.assertIsNone(rdfmagic.guess_serializer_name_by_extension('a.dat'))
+
     def test_guess_parser(self):
         self.assertEqual(rdfmagic.guess_parser_name(None, "diane.ttl"), 'turtle')
         self.assertEqual(rdfmagic.guess_parser_name(None, "diane.turtle"), 'turtle')
@@ -130,6 +776,11 @@ class TestRDFMagic(unittest.TestCase):
         self.assertEqual(rdfmagic.guess_parser_name(None, "diane.xhtml"), 'rdfa')
         self.assertEqual(rdfmagic.guess_parser_name(None, "diane.xml"), 'rdfxml')
         self.assertEqual(rdfmagic.guess_parser_name(None, "diane.rdf"), 'rdfxml')
+        self.assertEqual(rdfmagic.guess_parser_name(None, "diane.nt"), 'ntriples')
+        self.assertEqual(rdfmagic.guess_parser_name(None, "diane.nq.zst"), 'nquads')
+        self.assertEqual(rdfmagic.guess_parser_name(None, "diane.ttl.gz"), 'turtle')
+        self.assertEqual(rdfmagic.guess_parser_name('application/n-triples', 'foo'),
+                         'ntriples')
 
         self.assertEqual(rdfmagic.guess_parser_name('application/rdf+xml', 'foo'),
                          'rdfxml')
@@ -141,10 +792,99 @@ class TestRDFMagic(unittest.TestCase):
                          'guess')
 
 
+ENDPOINT_RESULTS = {
+    'head': {'vars': ['s', 'name']},
+    'results': {'bindings': [
+        {'s': {'type': 'uri', 'value': 'http://example.org/#spiderman'},
+         'name': {'type': 'literal', 'value': 'Spiderman'}},
+        {'s': {'type': 'uri', 'value': 'http://example.org/#spiderman'},
+         'name': {'type': 'literal', 'value': 'Человек-паук', 'xml:lang': 'ru'}},
+        {'s': {'type': 'bnode', 'value': 'b0'}},
+    ]},
+}
+
+
+class FakeEndpointHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length'))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        self.server.queries.append(form['query'][0])
+        body = json.dumps(ENDPOINT_RESULTS).encode('utf-8')
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as zipped:
+            zipped.write(body)
+        body = compressed.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                FakeEndpointHandler)
+        self.server.queries = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/sparql'.format(self.server.server_port)
+        self.shell = InteractiveShell()
+        self.magic = rdfmagic.SPARQLMagics(self.shell)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_query_endpoint(self):
+        pool = rdfmagic.ConnectionPool()
+        for i in range(2):
+            results = rdfmagic.query_endpoint(
+                self.url, 'select ?s ?name where { ?s ?p ?name }', pool=pool)
+            self.assertEqual(results.columns, ['s', 'name'])
+            self.assertEqual(len(results), 3)
+            self.assertEqual(str(results[0]['s'].uri),
+                             'http://example.org/#spiderman')
+            self.assertIsNone(results[2]['name'])
+        self.assertEqual(pool.created, 1)
+        pool.close()
+
+    def test_sparql_endpoint_magic(self):
+        self.magic.sparql('--endpoint {0} -o found'.format(self.url),
+                          'select ?s ?name from <http://example.org/> '
+                          'where { ?s ?p ?name }')
+        self.assertEqual(len(self.shell.user_ns['found']), 3)
+        self.assertIn('from <http://example.org/>', self.server.queries[0])
+
+        results = self.magic.roqet('-p ' + self.url,
+                                   'select ?s ?name where { ?s ?p ?name }')
+        self.assertEqual(len(results), 3)
+
+    def test_parse_tsv(self):
+        document = io.BytesIO(
+            b'?s\t?o\n'
+            b'<http://example.org/a>\t"a \\"b\\""@en\n'
+            b'_:b1\t42\n'
+            b'<http://example.org/c>\t\n')
+        results = rdfmagic.parse_sparql_results_tsv(document)
+        self.assertEqual(results.columns, ['s', 'o'])
+        self.assertEqual(str(results[0]['o']), 'a "b"')
+        self.assertEqual(rdfmagic.node_kind(results[1]['o']), 'integer')
+        self.assertIsNone(results[2]['o'])
+
+
 def suite():
     from unittest import TestSuite, defaultTestLoader
     suite = TestSuite()
     suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestRDFMagic))
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestEndpoint))
     return suite
 
 if __name__ == "__main__":
@@ -24,6 +24,7 @@ setup(
     author='Diane Trout',
     author_email='diane@ghic.org',
     packages=['rdfmagic'],
-    install_requires=['IPython >= 0.12', 'six'],
+    install_requires=['IPython >= 0.12', 'six',
+                      'futures; python_version < "3"'],
     test_suite='rdfmagic.test.test_rdfmagic.suite'
 )